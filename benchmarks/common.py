@@ -0,0 +1,44 @@
+import gc
+import time
+import torch
+import numpy as np
+
+
+def sync(device):
+    if 'cuda' in str(device):
+        torch.cuda.synchronize()
+
+
+def measure(fn, n_iters=10, n_warmup=2, device='cpu', setup=None, min_time=0.):
+    """ wall-clock times (in seconds) of `fn()`, over at least `n_iters` calls
+        and at least `min_time` seconds. With `setup`, every call is
+        `fn(setup())`, and `setup` is not timed. The garbage collector is off
+        while timing """
+
+    call = fn if setup is None else (lambda : fn(setup()))
+
+    for _ in range(n_warmup):
+        call()
+
+    gc.collect()
+    gc.disable()
+
+    try:
+        times = []
+        while len(times) < n_iters or sum(times) < min_time:
+            args = None if setup is None else setup()
+            sync(device)
+            start = time.perf_counter()
+            fn() if setup is None else fn(args)
+            sync(device)
+            times += [time.perf_counter() - start]
+    finally:
+        gc.enable()
+
+    return times
+
+
+def timeit(fn, n_iters=10, n_warmup=2, device='cpu', setup=None, min_time=0.):
+    """ returns the median wall-clock time (in seconds) of `fn()` (see `measure`) """
+
+    return float(np.median(measure(fn, n_iters, n_warmup, device, setup, min_time)))
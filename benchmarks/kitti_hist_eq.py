@@ -0,0 +1,46 @@
+""" Histogram equalization of lidar frames: per-sample `np.interp` (previous
+    `Kitti_dataset.norm / unnorm`) vs. batched, torch-native `Interp`.
+
+    python -m benchmarks.kitti_hist_eq --device cuda
+"""
+import argparse
+import numpy as np
+import torch
+
+from utils.data import Interp, KITTI_HIST, BINS
+from benchmarks.common import timeit
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 4, 16, 64, 256])
+    parser.add_argument('--data_size', type=int, nargs='+', default=[2, 40, 512])
+    parser.add_argument('--device', type=str, default='cpu')
+    args = parser.parse_args()
+
+    cdf = KITTI_HIST.cumsum()
+    cdf = 255 * cdf / cdf[-1]
+    norm, unnorm = Interp(BINS[:-1], cdf), Interp(cdf, BINS[:-1])
+
+    # previous implementations
+    np_norm   = lambda x : np.interp(x.flatten(), BINS[:-1], cdf).reshape(x.shape).astype(np.float32)
+    np_unnorm = lambda x : torch.from_numpy(np.interp(x.cpu().data.numpy().flatten(), cdf, BINS[:-1]) \
+                                .reshape(x.shape)).to(x.device).float()
+
+    print('bs\tnorm (np, per item)\tnorm (torch, batch)\tunnorm (np)\tunnorm (torch)\t[ms]')
+    for bs in args.batch_sizes:
+        x_np = (np.random.randn(bs, *args.data_size) * 10).astype(np.float32)
+        x    = torch.from_numpy(x_np).to(args.device)
+        y    = torch.rand_like(x) * 255
+
+        t_np_norm   = timeit(lambda : [np_norm(item) for item in x_np])
+        t_norm      = timeit(lambda : norm(x), device=args.device)
+        t_np_unnorm = timeit(lambda : np_unnorm(y), device=args.device)
+        t_unnorm    = timeit(lambda : unnorm(y), device=args.device)
+
+        print('{}\t{:.2f}\t\t\t{:.2f}\t\t\t{:.2f}\t\t{:.2f}'.format(
+            bs, *[1000 * t for t in (t_np_norm, t_norm, t_np_unnorm, t_unnorm)]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+""" Frames / second of the lidar input pipeline for different amounts of
+    DataLoader workers.
+
+    python -m benchmarks.kitti_loading                       # synthetic recordings
+    python -m benchmarks.kitti_loading --root ../datasets/processed_kitti --train
+"""
+import os
+import time
+import yaml
+import argparse
+import tempfile
+import numpy as np
+
+from utils.data  import Kitti_dataset, CLDataLoader
+from utils.utils import dotdict
+
+
+def make_recordings(root, n_recs, n_frames, shp):
+    paths = []
+    for rec in range(n_recs):
+        os.makedirs(os.path.join(root, str(rec)), exist_ok=True)
+        path = os.path.join(root, str(rec), 'processed.npz')
+        frames = {'%d.npy' % i: (np.random.randn(*shp) * 10).astype(np.float32) for i in range(n_frames)}
+        np.savez(path, **frames)
+        paths += [path]
+
+    return paths
+
+
+def find_recordings(root):
+    return [os.path.join(root, env, rec, 'processed.npz')
+                for env in sorted(os.listdir(root))
+                for rec in sorted(os.listdir(os.path.join(root, env)))]
+
+
+def run(loader, n_batches, step_fn=None):
+    n_frames = 0
+    it = iter(loader)
+    next(it) # exclude worker startup
+
+    start = time.perf_counter()
+    for i, (x, _, _) in enumerate(it):
+        if i >= n_batches: break
+        if step_fn is not None: step_fn(x)
+        n_frames += x.size(0)
+
+    return n_frames / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--root', type=str, default=None,
+            help='processed_kitti folder. Synthetic recordings are used if not set')
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, 2, 4, 8])
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--n_batches', type=int, default=20)
+    parser.add_argument('--train', action='store_true',
+            help='also run a generator update on every batch')
+    parser.add_argument('--config', type=str, default='config/lidar/3B_offline.yaml')
+    parser.add_argument('--device', type=str, default='cpu')
+    bench_args = parser.parse_args()
+
+    if bench_args.root is None:
+        tmp = tempfile.mkdtemp()
+        paths = make_recordings(tmp, 4, 200, (2, 40, 512))
+    else:
+        paths = find_recordings(bench_args.root)
+
+    dataset = Kitti_dataset(paths)
+
+    step_fn = None
+    if bench_args.train:
+        from common.modular import QStack
+
+        config = yaml.load(open(bench_args.config), Loader=yaml.FullLoader)
+        generator = QStack(**config).to(bench_args.device)
+
+        def step_fn(x):
+            x = x.to(bench_args.device)
+            max_ = x.reshape(x.size(0), -1).abs().max(dim=1)[0].view(-1, 1, 1, 1)
+            _, block_outs = generator(x / max_)
+            generator.optimize(block_outs)
+
+    print('workers\tframes/s')
+    for n_workers in bench_args.workers:
+        args = dotdict({'dataset': 'processed_kitti', 'batch_size': bench_args.batch_size,
+                        'num_workers': n_workers, 'persistent_workers': True, 'debug': False})
+        loader = CLDataLoader([dataset], args, train=True)[0]
+        print('{}\t{:.1f}'.format(n_workers, run(loader, bench_args.n_batches, step_fn)))
+
+
+if __name__ == '__main__':
+    main()
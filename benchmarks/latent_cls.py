@@ -0,0 +1,123 @@
+""" Classifier rehearsal : decode-then-classify (`ResNet18` on images) against
+    classifying the `z_q` of a block (`LatentResNet18`). Reports the replay
+    throughput (`QStack.sample`), the classifier step time, the time to build
+    a `ReplayDataset`, and the test accuracy, on a synthetic class-structured
+    dataset.
+
+    python -m benchmarks.latent_cls --device cuda --latent 1
+"""
+import argparse
+import time
+import yaml
+import torch
+from torch.nn import functional as F
+
+from common.modular import QStack
+from common.model   import ResNet18, LatentResNet18
+from utils.data     import ReplayDataset
+from benchmarks.common import sync, timeit
+
+
+def synthetic(n, protos, noise=1.5):
+    """ smooth, class dependent patterns plus noise, in [-1, 1] """
+    y = torch.randint(protos.size(0), (n,), device=protos.device)
+    x = protos[y] + torch.randn(n, *protos.shape[1:], device=protos.device) * noise
+    return x.clamp(-1, 1), y
+
+
+def fill_memory(generator, protos, args):
+    """ trains the generator, freezes its blocks and fills the memory """
+
+    for _ in range(args.gen_steps):
+        _, block_outs = generator(synthetic(args.bs, protos, args.noise)[0])
+        generator.optimize(block_outs)
+
+    for block in generator.blocks:
+        block.frozen_qt = True
+        block.init_ema()
+
+    # every sample goes to the most compressed block
+    generator.recon_th = float('inf')
+
+    for step in range(args.mem_steps):
+        x, y = synthetic(args.bs, protos, args.noise)
+        with torch.no_grad():
+            _, block_outs = generator(x)
+
+        generator.add_reservoir(x, {'y': y, 't': 0, 'bidx': torch.arange(args.bs, device=x.device),
+                                    'step': step}, block_outs)
+
+
+def run(generator, latent, protos, test, args):
+    if latent > 0:
+        classifier = LatentResNet18(args.n_classes, 20, input_size=generator.all_blocks[latent].z_shp)
+    else:
+        classifier = ResNet18(args.n_classes, 20, input_size=generator.dummy.z_shp)
+
+    classifier = classifier.to(args.device).train()
+    opt = torch.optim.SGD(classifier.parameters(), lr=args.lr, momentum=0.9)
+
+    t_sample = timeit(lambda : generator.sample(args.bs, latent=latent), device=args.device)
+
+    def step():
+        x, add_info = generator.sample(args.bs, latent=latent)
+        opt.zero_grad()
+        F.cross_entropy(classifier(x), add_info['y']).backward()
+        opt.step()
+
+    sync(args.device)
+    start = time.perf_counter()
+    for _ in range(args.cls_steps): step()
+    sync(args.device)
+    t_step = (time.perf_counter() - start) / args.cls_steps
+
+    t_replay = timeit(lambda : ReplayDataset(generator, latent=latent, device=args.device),
+                      n_iters=3, n_warmup=1, device=args.device)
+
+    classifier.eval()
+    with torch.no_grad():
+        x, y = test
+        acc  = (classifier(generator.encode(x, latent)).argmax(1) == y).float().mean().item()
+
+    return args.bs / t_sample, 1000 * t_step, 1000 * t_replay, acc
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', type=str, default='config/cifar/cifar_20_final.yaml')
+    parser.add_argument('--latent', type=int, nargs='+', default=[1])
+    parser.add_argument('--n_classes', type=int, default=10)
+    parser.add_argument('--bs', type=int, default=64)
+    parser.add_argument('--gen_steps', type=int, default=200)
+    parser.add_argument('--mem_steps', type=int, default=20)
+    parser.add_argument('--cls_steps', type=int, default=200)
+    parser.add_argument('--n_test', type=int, default=1000)
+    parser.add_argument('--lr', type=float, default=0.05)
+    parser.add_argument('--noise', type=float, default=1.5)
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+
+    config    = yaml.load(open(args.config), Loader=yaml.FullLoader)
+    generator = QStack(**config).to(args.device)
+
+    C, H, W = generator.dummy.z_shp
+    protos  = F.interpolate(torch.randn(args.n_classes, C, H // 8, W // 8), size=(H, W),
+                            mode='bilinear', align_corners=False).clamp(-1, 1).to(args.device)
+
+    fill_memory(generator, protos, args)
+    generator.eval()
+
+    test = synthetic(args.n_test, protos, args.noise)
+
+    print('memory : {} samples'.format([block.n_samples for block in generator.all_blocks]))
+    print('input\t\treplay [samples/s]\tcls. step [ms]\tReplayDataset [ms]\ttest acc')
+    for latent in [0] + args.latent:
+        name = 'image' if latent == 0 else 'z_q (%d)' % latent
+        print('{}\t{:.0f}\t\t\t{:.1f}\t\t{:.1f}\t\t\t{:.3f}'.format(name, *run(generator, latent, protos, test, args)))
+
+
+if __name__ == '__main__':
+    main()
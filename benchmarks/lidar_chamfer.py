@@ -0,0 +1,49 @@
+""" Chamfer path of `eval_gen_lidar`: polar --> xyz conversion of both clouds,
+    followed by the chamfer distance, for every block.
+
+    python -m benchmarks.lidar_chamfer --device cuda
+"""
+import argparse
+import numpy as np
+import torch
+
+from utils.utils import from_polar, get_chamfer
+from benchmarks.common import timeit
+
+
+def from_polar_uncached(velo):
+    """ previous implementation (with `.cuda()` replaced by the input device) """
+    angles = np.linspace(0, np.pi * 2, velo.shape[-1])
+    dist, z = velo[:, 0], velo[:, 1]
+
+    x = torch.Tensor(np.cos(angles)).to(velo.device).unsqueeze(0).unsqueeze(0) * dist
+    y = torch.Tensor(np.sin(angles)).to(velo.device).unsqueeze(0).unsqueeze(0) * dist
+
+    return torch.stack([x, y, z], dim=1)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--data_size', type=int, nargs='+', default=[2, 40, 512])
+    parser.add_argument('--n_blocks', type=int, default=3)
+    parser.add_argument('--device', type=str, default='cpu')
+    args = parser.parse_args()
+
+    chamfer = get_chamfer()
+
+    print('bs\tfrom_polar (uncached)\tfrom_polar (cached)\tchamfer, all blocks\t[ms]')
+    for bs in args.batch_sizes:
+        data_raw = torch.rand(bs, *args.data_size, device=args.device) * 40
+        recons   = [data_raw + torch.randn_like(data_raw) * .1 for _ in range(args.n_blocks)]
+
+        t_old = timeit(lambda : from_polar_uncached(data_raw), device=args.device)
+        t_new = timeit(lambda : from_polar(data_raw), device=args.device)
+        t_all = timeit(lambda : [chamfer(data_raw, recon) for recon in recons],
+                       n_iters=3, n_warmup=1, device=args.device)
+
+        print('{}\t{:.3f}\t\t\t{:.3f}\t\t\t{:.1f}'.format(bs, *[1000 * t for t in (t_old, t_new, t_all)]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+""" Greedy optimization of 1, 2 and 3 block stacks : serial block updates
+    against concurrent ones (`opt_threads` in `opt_args`). Times a full
+    training step (forward + `QStack.optimize`).
+
+    python -m benchmarks.parallel_opt --torch_threads 1
+"""
+import argparse
+import yaml
+import torch
+
+from common.modular import QStack
+from benchmarks.common import timeit
+
+
+def stack_config(config, n_blocks, opt_threads):
+    """ `n_blocks` copies of the first block of `config`, each downsampling by 2 """
+
+    config = yaml.safe_load(yaml.safe_dump(config))
+    block  = config['block_args'][0]
+    H, W   = block['argmin_shp']
+
+    config['block_args'] = {}
+    for i in range(n_blocks):
+        config['block_args'][i] = dict(block, in_channel=block['in_channel'] if i == 0 else block['channel'],
+                                       argmin_shp=[H // 2 ** i, W // 2 ** i])
+
+    config['opt_args']['opt_threads'] = opt_threads
+    config['mem_args']['mem_size']    = 10 ** 6
+
+    return config
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', type=str, default='config/cifar/cifar_20_final.yaml')
+    parser.add_argument('--n_blocks', type=int, nargs='+', default=[1, 2, 3])
+    parser.add_argument('--bs', type=int, default=64)
+    parser.add_argument('--torch_threads', type=int, default=None,
+            help='intra-op threads. Defaults to torch\'s choice')
+    parser.add_argument('--device', type=str, default='cpu')
+    args = parser.parse_args()
+
+    if args.torch_threads is not None:
+        torch.set_num_threads(args.torch_threads)
+
+    config = yaml.load(open(args.config), Loader=yaml.FullLoader)
+    x = torch.rand(args.bs, *config['data_args']['data_shp'], device=args.device) * 2 - 1
+
+    print('intra-op threads : %d' % torch.get_num_threads())
+    print('blocks\tserial [ms]\tthreaded [ms]\tspeedup')
+    for n_blocks in args.n_blocks:
+        times = []
+        for opt_threads in [0, n_blocks]:
+            torch.manual_seed(0)
+            generator = QStack(**stack_config(config, n_blocks, opt_threads)).to(args.device)
+
+            def step():
+                _, block_outs = generator(x)
+                generator.optimize(block_outs)
+
+            times += [timeit(step, n_iters=10, device=args.device)]
+
+        print('{}\t{:.1f}\t\t{:.1f}\t\t{:.2f}'.format(n_blocks, 1000 * times[0], 1000 * times[1], times[0] / times[1]))
+
+
+if __name__ == '__main__':
+    main()
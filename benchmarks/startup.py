@@ -0,0 +1,100 @@
+""" Startup cost of the entry points : wall time of `python <script> --help`
+    (interpreter start, imports and argument parsing), the heaviest imports
+    (`-X importtime`), the heavy optional modules that get imported, and the
+    time to build the models.
+
+    python -m benchmarks.startup --scripts cls_main.py gen_main.py
+"""
+import os
+import sys
+import time
+import argparse
+import subprocess
+import numpy as np
+
+ROOT  = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY = ['wandb', 'torchvision', 'matplotlib', 'scipy', 'torch.utils.cpp_extension']
+
+
+def time_help(script, n_iters):
+    """ median wall time of `python <script> --help` """
+
+    times = []
+    for _ in range(n_iters):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, script, '--help'], cwd=ROOT, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times += [time.perf_counter() - start]
+
+    return float(np.median(times))
+
+
+def import_profile(module, top):
+    """ total import time and the `top` slowest packages (cumulative, in ms) """
+
+    out = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import %s' % module],
+                         cwd=ROOT, check=True, stdout=subprocess.DEVNULL,
+                         stderr=subprocess.PIPE, universal_newlines=True).stderr
+
+    cumulative = {}
+    for line in out.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cum, name = line[len('import time:'):].split('|')
+        cumulative[name.strip()] = int(cum) / 1000.
+
+    total = cumulative.get(module, float('nan'))
+    # only the top-level package of every import
+    packages = {k: v for k, v in cumulative.items() if '.' not in k and k != module}
+    return total, sorted(packages.items(), key=lambda kv : -kv[1])[:top]
+
+
+def heavy_imports(module):
+    """ the modules of `HEAVY` loaded by `import module` """
+
+    code = 'import sys, {}; print(" ".join(m for m in {} if m in sys.modules))'.format(module, HEAVY)
+    out  = subprocess.run([sys.executable, '-c', code], cwd=ROOT, check=True,
+                          stdout=subprocess.PIPE, universal_newlines=True).stdout
+
+    return out.split()
+
+
+def time_models(config, n_iters):
+    """ median time to build the generator and the classifier """
+    import yaml
+    import torch
+    from common.modular import QStack
+    from common.model   import ResNet18
+    from benchmarks.common import timeit
+
+    config = yaml.load(open(os.path.join(ROOT, config)), Loader=yaml.FullLoader)
+    t_gen  = timeit(lambda : QStack(**config), n_iters=n_iters, n_warmup=1)
+    t_cls  = timeit(lambda : ResNet18(10, 20, input_size=(3, 32, 32)), n_iters=n_iters, n_warmup=1)
+
+    return t_gen, t_cls
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scripts', type=str, nargs='+', default=['cls_main.py', 'gen_main.py'])
+    parser.add_argument('--config', type=str, default='config/cifar/cifar_20_final.yaml')
+    parser.add_argument('--n_iters', type=int, default=5)
+    parser.add_argument('--top', type=int, default=5)
+    args = parser.parse_args()
+
+    print('script\t\t--help [ms]\timport [ms]\theavy modules')
+    for script in args.scripts:
+        module = os.path.splitext(script)[0]
+        t_help = time_help(script, args.n_iters)
+        t_import, top = import_profile(module, args.top)
+
+        print('{}\t{:.0f}\t\t{:.0f}\t\t{}'.format(script, 1000 * t_help, t_import,
+                                               ' '.join(heavy_imports(module)) or '-'))
+        print('\t' + ', '.join('{} {:.0f}'.format(k, v) for k, v in top))
+
+    t_gen, t_cls = time_models(args.config, args.n_iters)
+    print('QStack [ms] : {:.1f}\tResNet18 [ms] : {:.1f}'.format(1000 * t_gen, 1000 * t_cls))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,328 @@
+""" Microbenchmarks of the AQM hot paths, on synthetic tensors only (no dataset,
+    no network) :
+
+        quantize       `Quantize.forward` across K (codes), N (codebooks), and batch sizes
+        encoder        `Encoder` / `Decoder` forward throughput
+        buffer         `Buffer.add / free / sample / try_and_remove` across buffer sizes
+        stack          `QStack.sample`, `add_reservoir` and `balance_memory` at full memory
+
+    Every case is timed over at least `--n_iters` calls and `--min_time`
+    seconds. The results are written as JSON (`--out`), and compared against a
+    stored run (`--baseline`) : cases whose fastest runs are slower than the
+    baseline's by more than `--tolerance`, with non overlapping interquartile
+    ranges, are re-measured `--n_confirm` times. The ones still slower are
+    reported, and the exit code is 1. Every case yields (name, params, number
+    of items, function running the timing).
+
+    python -m benchmarks.suite --out benchmarks/baseline.json           # store a baseline
+    python -m benchmarks.suite --baseline benchmarks/baseline.json      # check for regressions
+"""
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+import yaml
+import torch
+import numpy as np
+
+from common.quantize import Quantize
+from common.model    import Encoder, Decoder
+from common.modular  import QStack
+from utils.buffer    import Buffer
+from benchmarks.common import measure
+
+N_CLASSES = 10
+
+
+# Cases
+# ------------------------------------------------------------------------------
+
+def bench_quantize(args):
+    Ks = [16, 512]   if args.quick else [16, 128, 512]
+    Ns = [1]         if args.quick else [1, 4]
+    Bs = [16]        if args.quick else [16, 128]
+    C, H, W = 128, 16, 16
+
+    def case(quantize, B):
+        x = torch.randn(B, C, H, W, device=args.device)
+        return lambda : time_case(lambda : quantize(x), args)
+
+    for K in Ks:
+        for N in Ns:
+            quantize = Quantize(C // N, K, N).to(args.device).train()
+
+            for B in Bs:
+                params = {'K': K, 'N': N, 'D': C // N, 'B': B, 'H': H, 'W': W}
+                yield 'quantize/K%d_N%d_B%d' % (K, N, B), params, B, case(quantize, B)
+
+
+def bench_encoder(args):
+    downsamples = [2]    if args.quick else [2, 4]
+    Bs          = [16]   if args.quick else [16, 128]
+    C, channel  = 3, 100
+
+    def cases(encoder, decoder, B):
+        x = torch.randn(B, C, 32, 32, device=args.device)
+        with torch.no_grad():
+            z = encoder(x)
+
+        # the decoder starts with an inplace ReLU : feed it a copy
+        return lambda : time_case(lambda : encoder(x), args), \
+               lambda : time_case(lambda z_ : decoder(z_), args, setup=lambda : z.clone())
+
+    for ds in downsamples:
+        encoder = Encoder(C, channel, ds).to(args.device).eval()
+        decoder = Decoder(channel, C, ds).to(args.device).eval()
+
+        for B in Bs:
+            params = {'downsample': ds, 'B': B, 'channel': channel}
+            run_enc, run_dec = cases(encoder, decoder, B)
+
+            yield 'encoder/ds%d_B%d' % (ds, B), params, B, run_enc
+            yield 'decoder/ds%d_B%d' % (ds, B), params, B, run_dec
+
+
+def random_codes(n, input_size, max_idx, device):
+    return torch.randint(int(max_idx), (n,) + tuple(input_size), device=device)
+
+
+def random_info(n, device, step=0):
+    return {'y':    torch.randint(N_CLASSES, (n,), device=device),
+            't':    0,
+            'bidx': torch.arange(n, device=device),
+            'step': step}
+
+
+def bench_buffer(args):
+    sizes = [1000, 10000] if args.quick else [1000, 10000, 50000]
+    B, input_size, max_idx = 20, (1, 16, 16), 16
+
+    def cases(size):
+        buf = Buffer(input_size, N_CLASSES, max_idx=max_idx).to(args.device)
+        buf.add(random_codes(size, input_size, max_idx, args.device), random_info(size, args.device))
+
+        nominal = {key: getattr(buf, key).clone() for key in ['bx', 'by', 'bt', 'bidx', 'bstep']}
+
+        def reset():
+            """ every call sees the buffer at its nominal size and content """
+            for key, value in nominal.items():
+                setattr(buf, key, value.clone())
+
+            buf.n_samples = size
+            buf.n_memory  = buf.memory()
+
+        def add_input():
+            reset()
+            mask = torch.ones(B, dtype=torch.bool, device=args.device)
+            return random_codes(B, input_size, max_idx, args.device), random_info(B, args.device), mask
+
+        def free_input():
+            reset()
+            return torch.randperm(size, device=args.device)[:B]
+
+        def remove_input():
+            reset()
+            return buf.y.sum(0)
+
+        y_samples = torch.full((N_CLASSES,), B // N_CLASSES, dtype=torch.long, device=args.device)
+
+        return {'add':    lambda : time_case(lambda inp : buf.add(inp[0], inp[1], idx=inp[2]), args,
+                                             setup=add_input),
+                'free':   lambda : time_case(lambda idx : buf.free(idx=idx), args, setup=free_input),
+                'sample': lambda : time_case(lambda _ : buf.sample(y_samples=y_samples), args, setup=reset),
+                'try_and_remove': lambda : time_case(lambda counts : buf.try_and_remove(B, counts), args,
+                                                     setup=remove_input)}
+
+    for size in sizes:
+        for op, run in cases(size).items():
+            yield 'buffer/%s_%d' % (op, size), {'size': size, 'B': B}, B, run
+
+
+def full_stack(config, mem_size, device):
+    """ a frozen stack whose memory is full of random codes """
+
+    config = yaml.safe_load(yaml.safe_dump(config))
+    config['mem_args']['mem_size'] = mem_size
+
+    generator = QStack(**config).to(device).eval()
+    generator.recon_th = float('inf')
+
+    for block in generator.blocks:
+        block.frozen_qt = True
+        block.init_ema()
+
+    # store everything in the most compressed block, as a trained model would
+    block = generator.all_blocks[-1]
+    n = int(generator.mem_size / block.mem_per_sample) + 1
+    block.buffer.add(random_codes(n, block.buffer.input_size, block.buffer.max_idx, device),
+                     random_info(n, device))
+    generator.balance_memory()
+
+    return generator
+
+
+def bench_stack(args):
+    mem_sizes = [20] if args.quick else [20, 100]
+    Ns        = [10] if args.quick else [10, 100]
+    B         = 10
+
+    config = yaml.load(open(args.config), Loader=yaml.FullLoader)
+
+    def cases(generator):
+        x = torch.rand(B, *generator.dummy.z_shp, device=args.device) * 2 - 1
+        with torch.no_grad():
+            _, block_outs = generator(x)
+
+        block = generator.all_blocks[-1]
+        def overflow():
+            block.buffer.add(random_codes(B, block.buffer.input_size, block.buffer.max_idx, args.device),
+                             random_info(B, args.device))
+
+        # memory stays full : every call adds (or overflows by) B samples, and balancing removes as many
+        out = {'sample_n%d' % n : (n, lambda n=n : time_case(lambda : generator.sample(n), args)) for n in Ns}
+        out['add_reservoir'] = (B, lambda : time_case(
+            lambda : generator.add_reservoir(x, random_info(B, args.device), block_outs), args))
+        out['balance_memory'] = (B, lambda : time_case(
+            lambda _ : generator.balance_memory(), args, setup=overflow))
+
+        return out
+
+    for mem_size in mem_sizes:
+        generator = full_stack(config, mem_size, args.device)
+        params    = {'mem_size': mem_size, 'n_samples': generator.n_samples}
+
+        for op, (n_items, run) in cases(generator).items():
+            yield 'stack/%s_m%d' % (op, mem_size), dict(params, n_items=n_items), n_items, run
+
+
+GROUPS = {'quantize': bench_quantize,
+          'encoder':  bench_encoder,
+          'buffer':   bench_buffer,
+          'stack':    bench_stack}
+
+
+# Running and comparing
+# ------------------------------------------------------------------------------
+
+@torch.no_grad()
+def time_case(fn, args, setup=None):
+    """ summary (in ms) of the times of `fn` """
+
+    times = 1000 * np.array(measure(fn, n_iters=args.n_iters, n_warmup=args.n_warmup, device=args.device,
+                                    setup=setup, min_time=args.min_time))
+    q1, median, q3 = np.percentile(times, [25, 50, 75])
+
+    return {'median_ms': median, 'min_ms': times.min(), 'q1_ms': q1, 'q3_ms': q3, 'n': len(times)}
+
+
+def meta(args):
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL, universal_newlines=True).stdout.strip()
+    except OSError:
+        commit = None
+
+    return {'time':     time.strftime('%Y-%m-%d %H:%M:%S'),
+            'commit':   commit,
+            'python':   platform.python_version(),
+            'torch':    torch.__version__,
+            'device':   args.device,
+            'threads':  torch.get_num_threads(),
+            'machine':  platform.machine(),
+            'quick':    args.quick}
+
+
+def is_regression(res, base, tolerance):
+    """ the fastest runs are more than `tolerance` slower than the baseline's,
+        and the interquartile ranges do not overlap : noise on a few runs, or
+        a wide spread of times, is not reported """
+
+    ratio = res['min_ms'] / base.get('min_ms', base['median_ms'])
+    apart = res['q1_ms'] > base.get('q3_ms', base['median_ms'])
+
+    return ratio, ratio > 1 + tolerance and apart
+
+
+def compare(results, baseline, tolerance):
+    """ cases slower than the baseline by more than `tolerance` (relative) """
+
+    regressions = []
+
+    print('\n{:<40} {:>12} {:>12} {:>8}'.format('case', 'base [ms]', 'new [ms]', 'ratio'))
+    for name, res in results.items():
+        if name not in baseline:
+            continue
+
+        ratio, slower = is_regression(res, baseline[name], tolerance)
+        if slower: regressions += [name]
+
+        print('{:<40} {:>12.3f} {:>12.3f} {:>8.2f}{}'.format(
+            name, baseline[name].get('min_ms', baseline[name]['median_ms']), res['min_ms'], ratio,
+            '  <-- slower' if slower else ''))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--groups', type=str, nargs='+', default=list(GROUPS), choices=list(GROUPS))
+    parser.add_argument('--filter', type=str, default=None, help='only run the cases containing this string')
+    parser.add_argument('--config', type=str, default='config/cifar/cifar_20_final.yaml')
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--n_iters', type=int, default=20, help='min. amount of timed calls per case')
+    parser.add_argument('--n_warmup', type=int, default=5)
+    parser.add_argument('--min_time', type=float, default=0.5, help='min. timed seconds per case')
+    parser.add_argument('--quick', action='store_true', help='smaller grid')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', type=str, default=None, help='where to write the results (JSON)')
+    parser.add_argument('--baseline', type=str, default=None, help='results (JSON) to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='relative slowdown w.r.t the baseline reported as a regression')
+    parser.add_argument('--n_confirm', type=int, default=2,
+                        help='regressions are re-measured this many times, and only reported if they persist')
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    np.random.seed(args.seed)
+
+    results, runs = {}, {}
+
+    print('{:<40} {:>12} {:>12} {:>14}'.format('case', 'median [ms]', 'min [ms]', 'items / s'))
+    for group in args.groups:
+        for name, params, n_items, run in GROUPS[group](args):
+            if args.filter is not None and args.filter not in name:
+                continue
+
+            res = run()
+            res.update(params=params, items_per_s=1000 * n_items / res['median_ms'])
+
+            results[name], runs[name] = res, run
+            print('{:<40} {:>12.3f} {:>12.3f} {:>14.0f}'.format(
+                name, res['median_ms'], res['min_ms'], res['items_per_s']))
+
+    if args.out is not None:
+        with open(args.out, 'w') as f:
+            json.dump({'meta': meta(args), 'results': results}, f, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+        regressions = compare(results, baseline['results'], args.tolerance)
+
+        # re-measure : a regression is only reported if it shows up every time
+        for _ in range(args.n_confirm):
+            regressions = [name for name in regressions
+                           if is_regression(runs[name](), baseline['results'][name], args.tolerance)[1]]
+
+        if regressions:
+            print('\nconfirmed after %d re-runs :\n' % args.n_confirm + '\n'.join(regressions))
+            print('\n%d regression(s) w.r.t %s (commit %s)' % (len(regressions), args.baseline,
+                                                               baseline['meta'].get('commit')))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
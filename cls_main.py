@@ -2,22 +2,24 @@ import os
 import sys
 import pdb
 import yaml
-import wandb
 import numpy as np
 from os.path import join
 from pydoc  import locate
 from copy   import deepcopy
+from functools import partial
 from collections import defaultdict
 from torch.nn import functional as F
-from torchvision.utils import save_image, make_grid
 
 from utils.data   import *
 from utils.buffer import *
 from utils.utils  import dotdict, set_seed
 from utils.args   import get_args
+from utils.logger import get_logger
+from utils.profiling import profiler, configure_profiler
+from utils.async_eval import AsyncEval
 
 from common.modular import QStack
-from common.model   import ResNet18
+from common.model   import ResNet18, LatentResNet18
 from eval import *
 
 np.set_printoptions(threshold=3)
@@ -28,10 +30,27 @@ rescale_inv = (lambda x : x * 0.5 + 0.5)
 best_test = float('inf')
 
 def sho(x):
+    from torchvision.utils import save_image
     save_image(x * .5 + .5, 'tmp.png')
     Image.open('tmp.png').show()
 
 
+def run_eval(models, loaders, args, logger, task, epoch):
+    generator, classifier = models['generator'], models['classifier']
+
+    # a latent classifier is evaluated on the encoded test images
+    transform = partial(generator.encode, block_id=args.cls_latent) if args.cls_latent > 0 else None
+
+    val_acc  = eval_cls(classifier, loaders['valid'], args, name='valid', max_task=task, logger=logger, transform=transform)
+    test_acc = eval_cls(classifier, loaders['test'], args, name='test', max_task=task, logger=logger, transform=transform)
+
+    if task % 2 == 0 or task < 2:
+        eval_gen('valid', generator, loaders['valid'], args, max_task=task, epoch=epoch, logger=logger)
+        eval_drift(generator, loaders['train'], args, logger=logger)
+
+    return task, val_acc, test_acc
+
+
 # ------------------------------------------------------------------------------
 # Train the model
 # ------------------------------------------------------------------------------
@@ -47,7 +66,8 @@ def main(args):
         set_seed(run)
 
         name = 'debug' if args.debug else args.config.split('/')[-1]
-        wandb.init(project='aqm_lite_cifar', name=name, config={'yaml':config, 'params':args}, reinit=True)
+        logger = get_logger(args, 'aqm_lite_cifar', name, config={'yaml':config, 'params':args})
+        configure_profiler(args)
 
         # fetch data
         data = locate('utils.data.get_%s' % args.dataset)(args)
@@ -61,7 +81,14 @@ def main(args):
         # fetch model and ship to GPU
 
         generator  = QStack(**config).to(args.device)
-        classifier = ResNet18(args.n_classes, 20, input_size=args.input_size)
+
+        if args.cls_latent > 0:
+            z_shp = generator.all_blocks[args.cls_latent].z_shp
+            build_classifier = partial(LatentResNet18, args.n_classes, 20, input_size=z_shp)
+        else:
+            build_classifier = partial(ResNet18, args.n_classes, 20, input_size=args.input_size)
+
+        classifier = build_classifier()
         classifier = classifier.to(args.device)
         print(generator)
 
@@ -73,6 +100,19 @@ def main(args):
         print("number of classifier parameters:", \
                 sum([np.prod(p.size()) for p in classifier.parameters()]))
 
+        loaders   = {'train': train_loader, 'valid': valid_loader, 'test': test_loader}
+        evaluator = None
+        if args.async_eval:
+            builders  = {'generator': partial(QStack, **config),
+                         'classifier': build_classifier}
+            evaluator = AsyncEval(run_eval, builders, loaders, args, logger)
+
+        def store(task, val_acc, test_acc):
+            RESULTS[run, 0, task, :task+1] = val_acc
+            RESULTS[run, 1, task, :task+1] = test_acc
+
+            print(RESULTS[run, 0, :task+1, :task+1])
+
         step = 0
         for task, tr_loader in enumerate(train_loader):
 
@@ -106,33 +146,41 @@ def main(args):
                         generator.optimize(block_outs)
 
                         if n_iter < args.cls_n_iters:
-                            opt_class.zero_grad()
-                            logits = classifier(input_x)
-
-                            if args.multiple_heads:
-                                mask = tr_loader.dataset.mask
-                                logits = logits.masked_fill(mask == 0, -1e9)
+                            with profiler.stage('classifier'):
+                                # a latent classifier reuses the `z_q` of the forward pass : no decoding
+                                cls_x, cls_re_x = input_x, re_x
+                                if args.cls_latent > 0:
+                                    z_q = block_outs[args.cls_latent]
+                                    cls_x = z_q['z_q' if re_x is None else 'z_q_inc'].detach()
+                                    if re_x is not None: cls_re_x = z_q['z_q_re'].detach()
 
-                            opt_class.zero_grad()
-                            loss_class = F.cross_entropy(logits, input_y)
-                            loss_class.backward()
-
-                            if args.rehearsal and task > 0:
-                                logits = classifier(re_x)
+                                opt_class.zero_grad()
+                                logits = classifier(cls_x)
 
                                 if args.multiple_heads:
-                                    mask = torch.zeros_like(logits)
-                                    task_ids = tr_loader.dataset.task_ids[sample_outs['t']]
-                                    mask.scatter_(1, task_ids, 1)
-                                    logits  = logits.masked_fill(mask == 0, -1e9)
+                                    mask = tr_loader.dataset.mask
+                                    logits = logits.masked_fill(mask == 0, -1e9)
 
-                                loss_class = F.cross_entropy(logits, sample_outs['y'])
+                                opt_class.zero_grad()
+                                loss_class = F.cross_entropy(logits, input_y)
                                 loss_class.backward()
 
-                            opt_class.step()
+                                if args.rehearsal and task > 0:
+                                    logits = classifier(cls_re_x)
+
+                                    if args.multiple_heads:
+                                        mask = torch.zeros_like(logits)
+                                        task_ids = tr_loader.dataset.task_ids[sample_outs['t']]
+                                        mask.scatter_(1, task_ids, 1)
+                                        logits  = logits.masked_fill(mask == 0, -1e9)
+
+                                    loss_class = F.cross_entropy(logits, sample_outs['y'])
+                                    loss_class.backward()
+
+                                opt_class.step()
 
                         if (i + 1) % 50 == 0:
-                            generator.log_to_server(wandb)
+                            generator.log_to_server(logger)
 
                     # set the gen. weights used for sampling == current generator weights
                     generator.update_ema_decoder()
@@ -148,6 +196,7 @@ def main(args):
                         )
 
                     step += 1
+                    profiler.step(logger)
 
                 # Test the model
                 # ------------------------------------------------------------------
@@ -156,17 +205,16 @@ def main(args):
             print(generator._fetch_y_counts()[:, :(task + 1) * args.n_classes_per_task])
             print(generator.mem_used / generator.data_size)
 
-            val_acc  = eval_cls(classifier, valid_loader, args, name='valid',  max_task=task)
-            test_acc = eval_cls(classifier, test_loader, args, name='test', max_task=task)
-
-            RESULTS[run, 0, task, :task+1] = val_acc
-            RESULTS[run, 1, task, :task+1] = test_acc
+            models = {'generator': generator, 'classifier': classifier}
 
-            print(RESULTS[run, 0, :task+1, :task+1])
+            if evaluator is not None:
+                evaluator.submit(step, models, task=task, epoch=epoch)
+                for _, out in evaluator.poll(): store(*out)
+            else:
+                store(*run_eval(models, loaders, args, logger, task=task, epoch=epoch))
 
-            if task % 2 == 0 or task < 2:
-                eval_gen('valid', generator, valid_loader, args, max_task=task, epoch=epoch)
-                eval_drift(generator, train_loader, args)
+        if evaluator is not None:
+            for _, out in evaluator.close(): store(*out)
 
         print(RESULTS[run, 0, -1].mean(), RESULTS[run, 1, -1].mean())
 
@@ -177,10 +225,10 @@ def main(args):
         max_test = RESULTS[run, 1].max(axis=0)
         fgt_test = (max_test - RESULTS[run, 1, -1])[:-1].mean()
 
-        wandb.log({'fgt_valid': fgt_valid,
-                   'acc_valid': RESULTS[run, 0, -1].mean(),
-                   'fgt_test':  fgt_test,
-                   'acc_test':  RESULTS[run, 1, -1].mean()})
+        logger.log({'fgt_valid': fgt_valid,
+                    'acc_valid': RESULTS[run, 0, -1].mean(),
+                    'fgt_test':  fgt_test,
+                    'acc_test':  RESULTS[run, 1, -1].mean()})
 
         if not args.debug:
             # save model
@@ -188,6 +236,9 @@ def main(args):
             save_path = os.path.join('/checkpoint/lucaspc/aqm/', args.name, 'gen.pth')
             torch.save(generator.state_dict(), save_path)
 
+        profiler.close()
+        logger.finish()
+
 
 if __name__ == '__main__':
     args = get_args()
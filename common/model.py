@@ -146,27 +146,25 @@ class BasicBlock(nn.Module):
 
 
 class ResNet(nn.Module):
-    def __init__(self, block, num_blocks, num_classes, nf, input_size):
+    def __init__(self, block, num_blocks, num_classes, nf, input_size, stem_ks=3, strides=(1, 2, 2, 2)):
         super(ResNet, self).__init__()
         self.in_planes = nf
         self.input_size = input_size
 
-        self.conv1 = conv3x3(input_size[0], nf * 1)
+        self.conv1 = nn.Conv2d(input_size[0], nf * 1, kernel_size=stem_ks,
+                               padding=stem_ks // 2, bias=False)
         self.bn1 = nn.BatchNorm2d(nf * 1)
-        self.layer1 = self._make_layer(block, nf * 1, num_blocks[0], stride=1)
-        self.layer2 = self._make_layer(block, nf * 2, num_blocks[1], stride=2)
-        self.layer3 = self._make_layer(block, nf * 4, num_blocks[2], stride=2)
-        self.layer4 = self._make_layer(block, nf * 8, num_blocks[3], stride=2)
+        self.layer1 = self._make_layer(block, nf * 1, num_blocks[0], stride=strides[0])
+        self.layer2 = self._make_layer(block, nf * 2, num_blocks[1], stride=strides[1])
+        self.layer3 = self._make_layer(block, nf * 4, num_blocks[2], stride=strides[2])
+        self.layer4 = self._make_layer(block, nf * 8, num_blocks[3], stride=strides[3])
 
-        last_hid = nf * 8 * block.expansion
-
-        # 128 x 128 mini-imagenet
-        if input_size[-1] == 128:
-            last_hid = 2560
+        # spatial size after the strided layers and the 4 x 4 average pooling
+        H, W = input_size[1:]
+        for stride in strides:
+            H, W = (H - 1) // stride + 1, (W - 1) // stride + 1
 
-        # 84 x 84 mini-imagenet
-        elif input_size[-1] == 84:
-            last_hid = 320
+        last_hid = nf * 8 * block.expansion * (H // 4) * (W // 4)
 
         self.linear = nn.Linear(last_hid, num_classes)
 
@@ -186,7 +184,7 @@ class ResNet(nn.Module):
         out = self.layer3(out)
         out = self.layer4(out)
         out = F.avg_pool2d(out, 4)
-        out = out.view(out.size(0), -1)
+        out = out.flatten(1)
         return out
 
     def forward(self, x):
@@ -198,3 +196,65 @@ def ResNet18(nclasses, nf=20, input_size=(3, 32, 32)):
     return ResNet(BasicBlock, [2, 2, 2, 2], nclasses, nf, input_size)
 
 
+def LatentResNet18(nclasses, nf=20, input_size=(100, 16, 16)):
+    """ ResNet18 on the quantized representation `z_q` of a block, of shape
+        `input_size`. The stem is a 1x1 conv. mixing the code embeddings, and
+        only the downsampling needed to reach 4 x 4 feature maps is kept """
+
+    n_down  = max(0, min(3, int(math.log2(input_size[-1] // 4))))
+    strides = [1] * (4 - n_down) + [2] * n_down
+
+    return ResNet(BasicBlock, [2, 2, 2, 2], nclasses, nf, input_size, stem_ks=1, strides=strides)
+
+
+@torch.no_grad()
+def fold_bn(model):
+    """ folds (in place) the batchnorms of an eval mode model into the preceding
+        convolutions : the `conv<i>` / `bn<i>` pairs of a module, and the
+        consecutive (Conv2d, BatchNorm2d) of an `nn.Sequential` """
+
+    def fold(conv, bn):
+        scale = bn.weight / (bn.running_var + bn.eps).sqrt()
+        bias  = conv.bias if conv.bias is not None else torch.zeros_like(bn.running_mean)
+
+        conv.weight.mul_(scale.view(-1, 1, 1, 1))
+        conv.bias = nn.Parameter((bias - bn.running_mean) * scale + bn.bias)
+
+    for module in list(model.modules()):
+        if isinstance(module, nn.Sequential):
+            for i in range(len(module) - 1):
+                if isinstance(module[i], nn.Conv2d) and isinstance(module[i + 1], nn.BatchNorm2d):
+                    fold(module[i], module[i + 1])
+                    module[i + 1] = nn.Identity()
+
+        for name, child in list(module.named_children()):
+            conv = getattr(module, 'conv' + name[2:], None) if name.startswith('bn') else None
+
+            if isinstance(child, nn.BatchNorm2d) and isinstance(conv, nn.Conv2d):
+                fold(conv, child)
+                setattr(module, name, nn.Identity())
+
+    return model
+
+
+
+
+if __name__ == '__main__':
+    """ smoke test : the classifiers on every input size used, as eval runs them
+        (channels last, folded batchnorm) """
+    from copy import deepcopy
+
+    shapes = [(3, 32, 32), (3, 84, 84), (3, 128, 128)]
+    models = [ResNet18(10, 20, input_size=shp) for shp in shapes]
+
+    latent_shapes = [(100, 16, 16), (100, 8, 8), (64, 32, 32)]
+    models += [LatentResNet18(10, 20, input_size=shp) for shp in latent_shapes]
+
+    for model, shp in zip(models, shapes + latent_shapes):
+        model = fold_bn(deepcopy(model).eval()).to(memory_format=torch.channels_last)
+        x = torch.randn(2, *shp).contiguous(memory_format=torch.channels_last)
+
+        with torch.no_grad():
+            assert model(x).shape == (2, 10), shp
+
+    print('ok')
@@ -4,19 +4,26 @@ import pdb
 import torch
 from torch import nn
 from copy import deepcopy
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 from torch.nn import functional as F
 
 sys.path += ['../']
 
 from utils.utils     import *
 from utils.buffer    import *
-from common.quantize import Quantize
+from common.quantize import Quantize, cast_weights, size_in_bytes, ema_update
 from common.model    import Encoder, Decoder
+from utils.profiling import profiler, profiled
 
-from torchvision.utils import save_image
 from PIL import Image
 
 
+@lru_cache(maxsize=None)
+def thread_pool(n_threads):
+    return ThreadPoolExecutor(n_threads)
+
+
 # Quantization Building Block
 # ------------------------------------------------------
 
@@ -29,7 +36,7 @@ class QLayer(nn.Module):
         self.id        = id
         self.avg_comp  = 0.
         self.avg_l2    = 0.
-        self.logger    = RALog()
+        self.logger    = RALog(intervals=kwargs.get('log_intervals', None))
         self.log       = self.logger.log
         self.opt       = None
 
@@ -50,6 +57,7 @@ class QLayer(nn.Module):
             self.buffer = Buffer(data_shp, n_classes, dtype=torch.FloatTensor)
             self.mem_per_sample = np.prod(data_shp)
             self.comp_rate = 1
+            self.z_shp     = tuple(data_shp)
             return
 
         # build quantization blocks
@@ -61,14 +69,20 @@ class QLayer(nn.Module):
         self.frozen_qt   = False
         self.downsample  = downsample
 
+        # storage precision of the old decoder : 'fp32', 'fp16', 'bf16' or 'int8'
+        self.ema_dtype   = kwargs.get('ema_dtype', 'fp32')
+
         argmin_shp = [n_codebooks] + argmin_shp
-        self.buffer = Buffer(argmin_shp, n_classes, max_idx=n_embeds)
+        self.z_shp = (N * (D // N),) + tuple(argmin_shp[1:])
+        self.buffer = Buffer(argmin_shp, n_classes, max_idx=n_embeds,
+                             keyframe_interval=kwargs.get('keyframe_interval', 0))
         self.mem_per_sample = self.buffer.mem_per_sample
 
         self.comp_rate   = np.prod(data_shp) / np.prod(argmin_shp) * np.log2(256) / np.log2(K)
         print('block ({})\t comp rate : {:.4f}'.format(self.id, self.comp_rate))
 
-        self.size_in_floats = sum(np.prod(p.size()) for p in self.parameters())
+        # weights count against the memory, with their storage precision (1 == fp32)
+        self.size_in_floats = size_in_bytes(self) / 4.
 
         assert -.01 < (self.buffer.mem_per_sample - np.prod(data_shp) / self.comp_rate) < .01
 
@@ -98,16 +112,16 @@ class QLayer(nn.Module):
 
         decay = .99
         try:
-            for ema_param, param in zip(self.ema_decoder.parameters(), self.decoder.parameters()):
-                ema_param.data.copy_(decay * ema_param.data + (1. - decay) * param.data)
+            with profiler.stage('block%d', self.id):
+                ema_update(self.ema_decoder, self.decoder, decay)
         except:
             pass
 
 
     def init_ema(self):
-        self.ema_decoder = deepcopy(self.decoder)
+        self.ema_decoder = cast_weights(deepcopy(self.decoder), self.ema_dtype)
 
-        self.size_in_floats += sum(np.prod(p.size()) for p in self.ema_decoder.parameters())
+        self.size_in_floats = size_in_bytes(self) / 4.
 
 
     def sample_everything(self, **kwargs):
@@ -120,6 +134,12 @@ class QLayer(nn.Module):
             yield z_q, add_info
 
 
+    def fetch(self, idx):
+        """ quantized representation of the buffer samples at `idx` """
+        argmin = self.buffer.get_x(idx)
+        return self.quantize.idx_2_hid(argmin) if hasattr(self, 'quantize') else argmin
+
+
     def sample(self, **kwargs):
         argmin, add_info = self.buffer.sample(**kwargs)
         z_q = self.quantize.idx_2_hid(argmin) if hasattr(self, 'quantize') else argmin
@@ -134,7 +154,8 @@ class QLayer(nn.Module):
         """ Encoding process """
 
         # downsample
-        z_e   = self.encoder(x)
+        with profiler.stage('block%d/encoder', self.id):
+            z_e = self.encoder(x)
 
         # Used to be 75 --> now 90 --> now 95
         if self.avg_comp > .90 and not self.frozen_qt:
@@ -149,12 +170,16 @@ class QLayer(nn.Module):
             print('new comp rate : {:.4f}'.format(self.comp_rate))
 
         # quantize
-        z_q, diff, argmin, ppl = self.quantize(z_e)
+        with profiler.stage('block%d/quantize', self.id):
+            z_q, diff, argmin, ppl = self.quantize(z_e)
 
         output = {'x': x, 'z_e': z_e, 'z_q': z_q, 'ppl': ppl, 'diff': diff, 'argmin': argmin}
 
+        # amount of codes used, counted on device (no sync)
+        n_used = lambda : argmin.new_zeros(self.quantize.embed.size(1)).index_fill_(0, argmin.flatten(), 1).sum()
+
         self.log('ppl', ppl)
-        self.log('argmin_unique', argmin.unique().size(0))
+        self.log('argmin_unique', n_used)
 
         return z_q, output
 
@@ -162,7 +187,8 @@ class QLayer(nn.Module):
     def down(self, z):
         """ Decoding Process """
 
-        return  self.decoder(z)
+        with profiler.stage('block%d/decoder', self.id):
+            return  self.decoder(z)
 
 
 # Quantization Network (stack QLayers)
@@ -199,6 +225,9 @@ class QStack(nn.Module):
         self.opt         = opt_args['opt']
         self.input       = opt_args['input']
         self.commit_coef = opt_args['commit_coef']
+
+        # > 0 : greedy updates of the blocks run concurrently, on this many threads
+        self.opt_threads = opt_args.get('opt_threads', 0)
         self.recon_loss  = F.l1_loss if opt_args.get('recon_loss', '') == 'l1' else F.mse_loss
 
         if self.opt == 'global':
@@ -235,6 +264,7 @@ class QStack(nn.Module):
         return mem_size
 
 
+    @profiled('track')
     def track(self):
         self.log('n_samples', self.n_samples)
         self.log('mem_used',  self.mem_used / self.mem_size)
@@ -242,14 +272,15 @@ class QStack(nn.Module):
         for block in self.blocks: block.track()
 
 
-    def log_to_server(self, wandb):
-        wandb.log(self.logger.avg_dict())
-        for block in self.blocks: wandb.log(block.logger.avg_dict(prefix=str(block.id)))
+    def log_to_server(self, logger):
+        logger.log(self.logger.avg_dict())
+        for block in self.blocks: logger.log(block.logger.avg_dict(prefix=str(block.id)))
 
         self.logger.reset()
         for block in self.blocks: block.logger.reset()
 
 
+    @profiled('update_ema_decoder')
     def update_ema_decoder(self):
         """ update the `old decoders` copy for every block """
 
@@ -257,6 +288,7 @@ class QStack(nn.Module):
             block.update_ema_decoder()
 
 
+    @profiled('up')
     def up(self, x):
         """ Encoding process """
 
@@ -278,35 +310,42 @@ class QStack(nn.Module):
         return x, block_outs
 
 
+    @profiled('down')
     def down(self, x, block_outs, decode_all=True):
-        """ Decoding Process """
+        """ Decoding Process. Every block decodes its own `z_q` into `x_hat`,
+            which is all its loss needs. With `decode_all`, the reconstructions
+            of the blocks above are also passed through its decoder (without
+            gradients), to get every block's reconstruction `x_final` """
 
         n_og_samples = x.size(0)
 
-        for i, block in enumerate(reversed(self.blocks)):
-            block_out = block_outs[block.id]
+        # reconstructions of the current block and the ones above, at the current level
+        recons = None
 
-            input = x
-            if i > 0:
-                if self.opt == 'greedy':
-                    input = x.detach()
+        # the decoders start with an inplace ReLU : only feed them tensors we own
+        for block in reversed(self.blocks):
+            block_out = block_outs[block.id]
 
-                if decode_all:
-                    input = torch.cat((block_out['z_q'], input))
+            x_hat = block.down(block_out['z_q'].clone())
+            block_out['x_hat'] = x_hat
 
-            x = block.down(input)
-            block_out['x_hat'] = x[:n_og_samples]
+            if recons is None or not decode_all:
+                recons = x_hat.detach().clone()
+            else:
+                with torch.no_grad():
+                    recons = torch.cat((x_hat.detach(), block.down(recons)))
 
         # (N, B, C, H, W) block_0, block_1, ...
-        x = x.view(self.n_blocks, n_og_samples, *x.shape[1:])
+        x = recons.view(-1, n_og_samples, *recons.shape[1:])
 
         # log the final output
-        for i, block_id in enumerate(sorted(block_outs.keys())):
-            block_outs[block_id]['x_final'] = x[i]
+        for block_id, x_final in zip(sorted(block_outs.keys()), x):
+            block_outs[block_id]['x_final'] = x_final
 
         return x, block_outs
 
 
+    @profiled('forward')
     def forward(self, x_inc, x_re=None):
 
         if x_re is None:
@@ -325,52 +364,81 @@ class QStack(nn.Module):
         return x, block_outs
 
 
-    def optimize(self, block_outs):
-        """ Loss calculation """
+    def block_loss(self, block, block_out):
+        """ loss of a single block """
 
-        total_loss = 0.
+        recon = self.recon_loss(block_out['x_hat'], block_out['x'])
+        diff  = block_out['diff'].mean()
 
-        if self.opt == 'global':
-            self.global_opt.zero_grad()
+        block.log('recon', recon)
+        block.log('diff',  diff)
 
-        for block in reversed(self.blocks):
-            block_out = block_outs[block.id]
+        # rehearse
+        if 'x_re' in block_out:
+            recon_re = self.recon_loss(block_out['x_hat_re'], block_out['x_re'])
+            diff_re  = block_out['diff_re'].mean()
 
-            if self.opt == 'greedy' and block.opt is not None:
-                block.opt.zero_grad()
+            block.log('recon_re', recon_re)
+            block.log('diff_re',  diff_re)
 
-            if block.downsample > 1:
+            recon += recon_re
+            diff  += diff_re
+
+        return recon + self.commit_coef * diff
 
-                recon = self.recon_loss(block_out['x_hat'], block_out['x'])
-                diff  = block_out['diff'].mean()
 
-                block.log('recon', recon)
-                block.log('diff',  diff)
+    def greedy_step(self, block, block_out):
+        """ backward and update of a single block """
 
-                # rehearse
-                if 'x_re' in block_out:
-                    recon_re = self.recon_loss(block_out['x_hat_re'], block_out['x_re'])
-                    diff_re  = block_out['diff_re'].mean()
+        if block.opt is None:
+            return
 
-                    block.log('recon_re', recon_re)
-                    block.log('diff_re',  diff_re)
+        block.opt.zero_grad()
 
-                    recon += recon_re
-                    diff  += diff_re
+        if block.downsample > 1:
+            with profiler.stage('block%d/backward', block.id):
+                self.block_loss(block, block_out).backward()
 
-                loss = recon + self.commit_coef * diff
+            with profiler.stage('block%d/step', block.id):
+                block.opt.step()
 
-                if self.opt == 'global':
-                    total_loss += loss
-                else:
-                    loss.backward()
-                    block.opt.step()
 
-        if self.opt == 'global':
-            total_loss.backward()
-            self.global_opt.step()
+    @profiled('optimize')
+    def optimize(self, block_outs):
+        """ Loss calculation """
+
+        if self.opt == 'greedy':
+            blocks = list(reversed(self.blocks))
+
+            if self.opt_threads > 0 and len(blocks) > 1:
+                # inputs are detached between blocks : the graphs are disjoint,
+                # and every block has its own optimizer
+                pool = thread_pool(self.opt_threads)
+                path = profiler.path()
+
+                def step(block):
+                    with profiler.inherit(path):
+                        self.greedy_step(block, block_outs[block.id])
+
+                list(pool.map(step, blocks))
+            else:
+                for block in blocks:
+                    self.greedy_step(block, block_outs[block.id])
+
+            return
+
+        self.global_opt.zero_grad()
+
+        total_loss = 0.
+        for block in reversed(self.blocks):
+            if block.downsample > 1:
+                total_loss += self.block_loss(block, block_outs[block.id])
 
+        total_loss.backward()
+        self.global_opt.step()
 
+
+    @profiled('add_to_buffer')
     @torch.no_grad()
     def add_to_buffer(self, x, add_info, block_outs, sample_x=None, sample_add_info=None):
 
@@ -448,6 +516,7 @@ class QStack(nn.Module):
         return sample.bincount(minlength=n_classes)
 
 
+    @profiled('balance_memory')
     @torch.no_grad()
     def balance_memory(self):
 
@@ -471,13 +540,18 @@ class QStack(nn.Module):
             mem_excess = self.mem_used - self.mem_size
 
 
+    @profiled('add_reservoir')
     def add_reservoir(self, x, add_info, block_outs, sample_x=None, sample_add_info=None):
         self.add_to_buffer(x, add_info, block_outs, sample_x=sample_x, sample_add_info=sample_add_info)
         self.balance_memory()
 
 
+    @profiled('sample')
     @torch.no_grad()
-    def sample(self, n_samples, exclude_task=None):
+    def sample(self, n_samples, exclude_task=None, latent=0):
+        """ `latent` > 0 returns the samples in the representation of block
+            `latent` instead of the input space. Blocks above it are only decoded
+            down to it, and samples of the blocks below it are encoded up """
 
         """ figure out from which blocks and labels to pull the samples """
 
@@ -523,6 +597,10 @@ class QStack(nn.Module):
 
             z_q, block_sample = block.sample(y_samples=block_samples)
 
+            if block.id < latent:
+                z_q = self.to_latent(z_q, block.id, latent) if z_q.size(0) > 0 else \
+                        input.new_empty((0,) + input.shape[1:])
+
             # first time collecting samples
             if input is None:
                 input    = z_q
@@ -531,46 +609,94 @@ class QStack(nn.Module):
                 input    = torch.cat((z_q, input))
                 add_info = dict_cat((block_sample, add_info))
 
-            input = block.ema_decoder(input)
+            if block.id > latent:
+                with profiler.stage('block%d/ema_decoder', block.id):
+                    input = block.ema_decoder(input)
 
         return input, add_info
 
 
-    def sample_everything(self):
-        for block in reversed(self.all_blocks):
-            for z_q, add_info in block.sample_everything():
+    @torch.no_grad()
+    def encode(self, x, block_id):
+        """ quantized representation `z_q` of `x` at block `block_id`. Unlike
+            `up`, nothing is logged and the codebooks are not updated """
+
+        if block_id == 0: return x
+
+        for i, block in enumerate(self.blocks):
+            if i > 0:
+                x = last_same_size_z
 
-                for block_ in self.all_blocks[::-1]:
-                    if block_.id > block.id: continue
-                    z_q = block_.ema_decoder(z_q)
+            z_e = block.encoder(x)
+            z_q = block.quantize.quantize(z_e)
 
-                yield z_q, add_info
+            if block.id == block_id: return z_q
+
+            if i == 0 or block.downsample > 1:
+                last_same_size_z = {'z_e': z_e, 'z_q': z_q}[self.input]
+
+
+    def decode(self, z_q, block_id, to_block=0):
+        """ decodes the representation of block `block_id` with the old decoders,
+            down to the representation of block `to_block` (0 == input space) """
+
+        for block_ in self.all_blocks[::-1]:
+            if block_.id > block_id or block_.id <= to_block: continue
+            z_q = block_.ema_decoder(z_q)
+
+        return z_q
+
+
+    def to_latent(self, z_q, block_id, latent=0):
+        """ representation of block `block_id` --> representation of block `latent` """
+
+        if block_id >= latent:
+            return self.decode(z_q, block_id, to_block=latent)
+
+        return self.encode(self.decode(z_q, block_id), latent)
+
+
+    def sample_everything(self, latent=0):
+        for block in reversed(self.all_blocks):
+            for z_q, add_info in block.sample_everything():
+                yield self.to_latent(z_q, block.id, latent), add_info
 
 
 def sho(x):
+    from torchvision.utils import save_image
     save_image(x * .5 + .5, 'tmp.png')
     Image.open('tmp.png').show()
 
 
 if __name__ == '__main__':
-    import sys
+    """ smoke test : train step, adding to the memory, rehearsal """
     import yaml
 
-    config = yaml.load(open('../test_config.yaml'), Loader=yaml.FullLoader)
+    path   = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../config/cifar/cifar_20_final.yaml')
+    config = yaml.load(open(path), Loader=yaml.FullLoader)
     aqm = QStack(**config)
 
-    x = torch.FloatTensor(16, 3, 32, 32).normal_()
+    x = torch.FloatTensor(16, 3, 32, 32).uniform_(-1, 1)
+    y = torch.arange(16) % 10
 
     out, block_outs = aqm(x)
+    aqm.optimize(block_outs)
+
+    for block in aqm.blocks:
+        block.frozen_qt = True
+        block.init_ema()
+
+    add_info = {'y': y, 't': 0, 'bidx': torch.arange(16), 'step': 0}
+    aqm.add_reservoir(x, add_info, block_outs)
+    assert aqm.n_samples == 16
 
-    y = torch.zeros(16).long()
-    in_idx = y
-    t = 1
-    s = 1
-    add_info = (y, t, in_idx, s)
+    re_x, re_info = aqm.sample(8)
+    # classes short on samples can return fewer than asked
+    assert re_x.shape[1:] == x.shape[1:] and re_x.size(0) == re_info['y'].size(0) <= 8
 
-    aqm.blocks[0].frozen_qt = True
-    aqm.blocks[1].frozen_qt = True
+    out, block_outs = aqm(x, x_re=re_x)
+    aqm.optimize(block_outs)
+    aqm.add_reservoir(x, dict(add_info, step=1), block_outs, sample_x=re_x, sample_add_info=re_info)
+    assert aqm.mem_used <= aqm.mem_size
 
-    aqm.add_to_buffer(x, add_info, block_outs)
-    # def add_to_buffer(x, add_info, block_outs, sample_outs=None):
+    print('ok')
@@ -194,3 +194,140 @@ class Quantize(nn.Module):
         return out
 
 
+
+# Low precision weight storage
+# ------------------------------------------------------------------------------
+
+WEIGHT_DTYPES = {'fp16': torch.float16, 'bf16': torch.bfloat16, 'int8': torch.int8}
+
+
+class WeightCast(object):
+    """
+    Stores the `weight` of a conv. / linear layer in `dtype`, as buffers
+    `weight_q` (and `weight_scale`, one fp32 scale per output channel, for int8).
+    Like `torch.nn.utils.weight_norm`, the fp32 weight is rebuilt before every
+    forward pass, and dropped after it.
+    """
+
+    def __init__(self, dtype, ch_dim):
+        self.dtype  = dtype
+        self.ch_dim = ch_dim
+
+    def quantize(self, weight, stochastic=False):
+        """ fp32 weight --> (stored weight, scale or None). With `stochastic`,
+            int8 and bf16 values are rounded up or down at random, with the
+            probabilities that make the rounding unbiased """
+
+        if self.dtype == torch.bfloat16 and stochastic:
+            # random low 16 bits, then truncation to the top 16 bits (== bf16)
+            bits = weight.float().contiguous().view(torch.int32)
+            bits = bits + torch.randint_like(bits, 0, 1 << 16)
+            return (bits & -(1 << 16)).view(torch.float32).to(torch.bfloat16), None
+
+        if self.dtype != torch.int8:
+            return weight.to(self.dtype), None
+
+        dims  = [d for d in range(weight.ndim) if d != self.ch_dim]
+        scale = weight.abs().amax(dim=dims, keepdim=True).clamp(min=1e-12) / 127.
+
+        weight = weight / scale
+        weight = (weight + torch.rand_like(weight)).floor() if stochastic else weight.round()
+
+        return weight.clamp(-127, 127).to(torch.int8), scale.float()
+
+    def store(self, module, weight, stochastic=False):
+        module.weight_q, scale = self.quantize(weight.detach(), stochastic=stochastic)
+        if scale is not None: module.weight_scale = scale
+
+    def load(self, module):
+        weight = module.weight_q.float()
+        if self.dtype == torch.int8: weight = weight * module.weight_scale
+
+        return weight
+
+    def __call__(self, module, inputs):
+        module.weight = self.load(module)
+
+    def release(self, module, inputs, output):
+        module.weight = None
+
+    def n_bytes(self, module):
+        return sum(b.numel() * b.element_size() for name, b in
+                        module.named_buffers(recurse=False) if name in ['weight_q', 'weight_scale'])
+
+    def load_dense(self, state_dict, prefix, *args):
+        """ fp32 checkpoints are quantized when loaded """
+
+        if prefix + 'weight' in state_dict:
+            weight_q, scale = self.quantize(state_dict.pop(prefix + 'weight'))
+            state_dict[prefix + 'weight_q'] = weight_q
+            if scale is not None: state_dict[prefix + 'weight_scale'] = scale
+
+    @staticmethod
+    def get(module):
+        for hook in module._forward_pre_hooks.values():
+            if isinstance(hook, WeightCast): return hook
+
+    @staticmethod
+    def apply(module, dtype):
+        # per output channel scales : (out, in, ...) weights, except for transposed conv.
+        ch_dim = 1 if isinstance(module, nn.ConvTranspose2d) else 0
+        fn     = WeightCast(dtype, ch_dim)
+
+        weight = module.weight.detach()
+        del module._parameters['weight']
+
+        weight_q, scale = fn.quantize(weight)
+        module.register_buffer('weight_q', weight_q)
+        if scale is not None: module.register_buffer('weight_scale', scale)
+        module.weight = None
+
+        module.register_forward_pre_hook(fn)
+        module.register_forward_hook(fn.release)
+        module._register_load_state_dict_pre_hook(fn.load_dense)
+
+        return fn
+
+
+def cast_weights(module, dtype='fp32'):
+    """ stores the conv. / linear weights of `module` in `dtype` (see `WeightCast`).
+        Biases are kept in fp32 """
+
+    if dtype == 'fp32' or not isinstance(module, nn.Module):
+        return module
+
+    for layer in module.modules():
+        if isinstance(layer, (nn.Conv2d, nn.ConvTranspose2d, nn.Linear)):
+            WeightCast.apply(layer, WEIGHT_DTYPES[dtype])
+
+    return module
+
+
+def size_in_bytes(module):
+    """ storage used by the parameters of `module`, and by its `WeightCast` weights """
+
+    n_bytes = sum(p.numel() * p.element_size() for p in module.parameters())
+
+    for layer in module.modules():
+        cast = WeightCast.get(layer)
+        if cast is not None: n_bytes += cast.n_bytes(layer)
+
+    return n_bytes
+
+
+@torch.no_grad()
+def ema_update(ema_module, module, decay):
+    """ ema_module <-- decay * ema_module + (1 - decay) * module. Weights stored
+        in low precision are updated in fp32, then stored back with stochastic
+        rounding : with round to nearest, int8 (and bf16) updates under half a
+        quantization step would be lost, and the old decoder would stop moving """
+
+    for ema_layer, layer in zip(ema_module.modules(), module.modules()):
+        cast = WeightCast.get(ema_layer)
+
+        for name, param in layer.named_parameters(recurse=False):
+            if cast is not None and name == 'weight':
+                cast.store(ema_layer, decay * cast.load(ema_layer) + (1. - decay) * param.data, stochastic=True)
+            else:
+                ema_param = getattr(ema_layer, name)
+                ema_param.data.copy_(decay * ema_param.data + (1. - decay) * param.data)
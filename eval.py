@@ -1,72 +1,74 @@
-import wandb
 import torch
+import weakref
 import numpy as np
+from copy import deepcopy
 from torch.nn import functional as F
-from torchvision.utils import save_image, make_grid
 
 from utils.data   import *
 from utils.buffer import *
 from utils.utils  import dotdict, set_seed, get_chamfer
+from utils.logger import NullLogger
 from utils.args   import get_args
 
 from common.modular import QStack
-from common.model   import ResNet18
+from common.model   import ResNet18, fold_bn
 
 
 @torch.no_grad()
-def eval_drift(aqm, loader, args, log=True):
+def eval_drift(aqm, loader, args, log=True, logger=NullLogger()):
+    from torchvision.utils import make_grid
 
-    all_loaders = list(loader)
+    datasets = loader.datasets
 
     imgs    = {block.id: None for block in aqm.blocks}
-    drifts  = {block.id: []   for block in aqm.blocks}
-    drifts0 = {block.id: []   for block in aqm.blocks}
+
+    # running (sum of batch mse, amount of batches)
+    drifts  = {block.id: [0., 0] for block in aqm.blocks}
+    drifts0 = {block.id: [0., 0] for block in aqm.blocks}
 
     if sum(block.frozen_qt for block in aqm.blocks) == 0: return
 
     for x, add_info in aqm.sample_everything():
-        block_id = add_info['bid'][0]
-        target = []
+        block_id = int(add_info['bid'][0])
 
         if block_id == 0: continue
 
-        target = []
-        for _idx, _task in zip(add_info['bidx'], add_info['t']):
-            loader = all_loaders[_task]
-            if 'cifar' in args.dataset:
-                target += [loader.dataset.rescale(loader.dataset.x[_idx])]
-            else:
-                target += [loader.dataset.__getitem__(_idx.item())[0]]
-
-        target = torch.stack(target).to(x.device)
+        # one read per task
+        task, bidx = add_info['t'].cpu(), add_info['bidx'].cpu()
+        target = torch.empty_like(x)
+        for task_ in task.unique().tolist():
+            target[(task == task_).to(x.device)] = \
+                    datasets[task_].get_batch(bidx[task == task_])[0].to(x.device, x.dtype)
 
         img = torch.stack((x, target)).transpose(1,0).reshape(-1, *x.shape[1:])
-        imgs[int(block_id)] = (img * .5 + .5).cpu()
-        drifts[int(block_id)] += [F.mse_loss(x, target)]
+        imgs[block_id] = img
+        drifts[block_id][0] += F.mse_loss(x, target)
+        drifts[block_id][1] += 1
 
-        if (add_info['t'] == 0).any():
-            drifts0[int(block_id)] += [
-                    F.mse_loss(x[add_info['t'] == 0], target[add_info['t'] == 0])
-                ]
+        is_0 = (task == 0).to(x.device)
+        if (task == 0).any():
+            drifts0[block_id][0] += F.mse_loss(x[is_0], target[is_0])
+            drifts0[block_id][1] += 1
 
     for key in drifts.keys():
-        if len(drifts0[key]) > 0:
-            mean0 = sum(drifts0[key]) / len(drifts0[key])
-            wandb.log({'drift0_%d' % key: mean0})
+        if drifts0[key][1] > 0:
+            mean0 = float(drifts0[key][0] / drifts0[key][1])
+            logger.log({'drift0_%d' % key: mean0})
 
-        if len(drifts[key]) > 0:
-            mean  = sum(drifts[key]) / len(drifts[key])
-            img   = imgs[key]
-            wandb.log({'drift_%d' % key: mean})
-            wandb.log({'img_drift_%d' % key:
-                [wandb.Image(make_grid(img), caption='drift %d' % key)]})
+        if drifts[key][1] > 0:
+            mean  = float(drifts[key][0] / drifts[key][1])
+            img   = (imgs[key] * .5 + .5).cpu()
+            logger.log({'drift_%d' % key: mean})
+            logger.log({'img_drift_%d' % key:
+                [logger.Image(make_grid(img), caption='drift %d' % key)]})
 
             print('{} \t{:.4f}'.format(key, mean))
 
 
 @torch.no_grad()
-def eval_gen(name, aqm, loader, args, log=True, max_task=-1, epoch=-1):
+def eval_gen(name, aqm, loader, args, log=True, max_task=-1, epoch=-1, logger=NullLogger()):
     """ evaluate performance on held-out data """
+    from torchvision.utils import make_grid
 
     print('eval test')
     with torch.no_grad():
@@ -93,15 +95,16 @@ def eval_gen(name, aqm, loader, args, log=True, max_task=-1, epoch=-1):
             all = all.transpose(1,0).reshape(-1, *all.shape[2:])
             all = make_grid(all, nrow=all_recons.size(0) + 1)
 
-            wandb.log({'test_recon_%d' % (epoch + max_task):
-                [wandb.Image(make_grid(all), caption='test recon')]})
+            logger.log({'test_recon_%d' % (epoch + max_task):
+                [logger.Image(make_grid(all), caption='test recon')]})
 
-            aqm.log_to_server(wandb)
+            aqm.log_to_server(logger)
 
 
 @torch.no_grad()
-def eval_gen_lidar(name, generator, loader, args, max_task=-1, epoch=-1):
+def eval_gen_lidar(name, generator, loader, args, max_task=-1, epoch=-1, logger=NullLogger()):
     """ evaluate performance on held-out data """
+    from torchvision.utils import make_grid
 
     chamfer = get_chamfer()
 
@@ -115,6 +118,7 @@ def eval_gen_lidar(name, generator, loader, args, max_task=-1, epoch=-1):
 
             for data_raw, target, _ in te_loader:
                 data_raw, target = data_raw.to(args.device), target.to(args.device)
+                data_raw = te_loader.dataset.equalize(data_raw)
 
                 # normalize point cloud
                 max_ = data_raw.reshape(data_raw.size(0), -1).abs().max(dim=1)[0].view(-1, 1, 1, 1)
@@ -138,45 +142,101 @@ def eval_gen_lidar(name, generator, loader, args, max_task=-1, epoch=-1):
         all = all.transpose(1,0).reshape(-1, *all.shape[2:])
         all = make_grid(all, nrow=all_recons.size(0) + 1)
 
-        wandb.log({'test_recon_%d' % (epoch + max_task):
-            [wandb.Image(make_grid(all), caption='test recon')]})
+        logger.log({'test_recon_%d' % (epoch + max_task):
+            [logger.Image(make_grid(all), caption='test recon')]})
 
-        generator.log_to_server(wandb)
+        generator.log_to_server(logger)
 
 
-@torch.no_grad()
-def eval_cls(classifier, loader, args, log=True, name='eval', max_task=-1):
+# test sets, normalized and stored on device : dataset --> (device, x, y)
+EVAL_DATA = weakref.WeakKeyDictionary()
 
-    classifier.eval()
+# largest batch size which fits in memory : (model, input shape, device, transformed) --> bs
+EVAL_BS = {}
 
-    accs  = np.zeros((max_task+1) if max_task > -1 else len(loader))
-    denos = np.zeros_like(accs)
 
-    for task_t, loader_t in enumerate(loader):
-        # only eval on seen tasks
-        if task_t > max_task >= 0:
-            break
+def eval_data(dataset, device):
+    if EVAL_DATA.get(dataset, (None,))[0] != str(device):
+        x, y = dataset.get_batch(torch.arange(len(dataset)))[:2]
+        x = x.to(device).contiguous(memory_format=torch.channels_last)
 
-        for data, target, _ in loader_t:
-            data, target = data.to(args.device), target.to(args.device)
+        EVAL_DATA[dataset] = (str(device), x, y.to(device))
 
-            logits = classifier(data)
+    return EVAL_DATA[dataset][1:]
 
-            if args.multiple_heads:
-                logits = logits.masked_fill(loader_t.dataset.mask==0, -1e9)
 
-            pred = logits.argmax(dim=1, keepdim=True)
-            correct = pred.eq(target.view_as(pred)).sum()
-            deno = data.size(0)
+def inference_model(model, fold=False):
+    """ eval mode, channels last copy of `model` """
 
-            accs[task_t]  += correct
-            denos[task_t] += deno
+    model = deepcopy(model).eval()
+    if fold: fold_bn(model)
 
-    accs = accs / denos
+    return model.to(memory_format=torch.channels_last)
 
-    if log:
-        wandb.log({'%s_acc' % name : accs.mean()})
 
-    return accs
+def predict(model, x, max_bs, mask=None, transform=None):
+    """ predictions for `transform(x)`, in batches as large as memory allows """
+
+    key = (type(model).__name__, tuple(x.shape[1:]), str(x.device), transform is not None)
+    bs  = EVAL_BS.get(key, max_bs)
+
+    if transform is None: transform = lambda x : x
+
+    preds, start = [], 0
+    while start < x.size(0):
+        try:
+            logits = model(transform(x[start:start + bs]))
+        except RuntimeError as e:
+            if 'out of memory' not in str(e) or bs == 1: raise
+
+            torch.cuda.empty_cache()
+            bs = bs // 2
+            continue
+
+        if mask is not None:
+            logits = logits.masked_fill(mask == 0, -1e9)
+
+        preds += [logits.argmax(dim=1)]
+        start += bs
+
+    EVAL_BS[key] = bs
+
+    return torch.cat(preds)
 
 
+def eval_cls(classifier, loader, args, log=True, name='eval', max_task=-1, logger=NullLogger(), transform=None):
+    """ `transform` maps the inputs to what the classifier consumes, e.g. the
+        `z_q` of a block (`QStack.encode`) for a latent classifier """
+
+    classifier.eval()
+
+    device = torch.device(args.device)
+    model  = inference_model(classifier, fold=args.fold_bn)
+
+    # accumulated on device, transferred once
+    correct = torch.zeros((max_task+1) if max_task > -1 else len(loader), device=device).long()
+    denos   = np.zeros(correct.size(0))
+
+    with torch.inference_mode():
+        for task_t in range(min(correct.size(0), len(loader))):
+            loader_t = loader[task_t]
+            mask = loader_t.dataset.mask if args.multiple_heads else None
+
+            if CLDataLoader.in_memory(loader_t.dataset):
+                batches = [eval_data(loader_t.dataset, device)]
+            else:
+                batches = ((data.to(device).contiguous(memory_format=torch.channels_last), target.to(device))
+                                for data, target, _ in loader_t)
+
+            for data, target in batches:
+                pred = predict(model, data, args.eval_bs, mask=mask, transform=transform)
+
+                correct[task_t] += pred.eq(target).sum()
+                denos[task_t]   += data.size(0)
+
+    accs = correct.cpu().numpy() / denos
+
+    if log:
+        logger.log({'%s_acc' % name : accs.mean()})
+
+    return accs
@@ -1,23 +1,25 @@
 import sys
 import pdb
 import yaml
-import wandb
 import numpy as np
 from os.path import join
 from pydoc  import locate
 from copy   import deepcopy
+from functools import partial
 from collections import defaultdict
 from torch.nn import functional as F
-from torchvision.utils import save_image, make_grid
 
 from utils.data   import *
 from utils.buffer import *
 from utils.utils  import dotdict
 from utils.args   import get_args
+from utils.logger import get_logger
+from utils.profiling import profiler, configure_profiler
+from utils.async_eval import AsyncEval
 from eval         import *
 
 from common.modular import QStack
-from common.model   import ResNet18
+from common.model   import ResNet18, LatentResNet18
 
 np.set_printoptions(threshold=3)
 
@@ -27,15 +29,38 @@ rescale_inv = (lambda x : x * 0.5 + 0.5)
 best_test = float('inf')
 
 def sho(x):
+    from torchvision.utils import save_image
     save_image(x * .5 + .5, 'tmp.png')
     Image.open('tmp.png').show()
 
 
-def offline_cls_train(aqm, valid_loader, test_loader, args):
+def offline_cls_train(aqm, valid_loader, test_loader, args, logger):
 
-    classifier = ResNet18(args.n_classes, 20, input_size=args.input_size).to(args.device)
+    transform = None
+    if args.cls_latent > 0:
+        # classify the `z_q` of a block : the memory is only decoded down to it
+        transform  = partial(aqm.encode, block_id=args.cls_latent)
+        classifier = LatentResNet18(args.n_classes, 20, input_size=aqm.all_blocks[args.cls_latent].z_shp)
+    else:
+        classifier = ResNet18(args.n_classes, 20, input_size=args.input_size)
+
+    classifier = classifier.to(args.device)
     opt  = torch.optim.SGD(classifier.parameters(), lr=args.cls_lr, momentum=0.9)
 
+    # the memory is frozen from now on : decode it once
+    replay = ReplayDataset(aqm, as_uint8=args.replay_uint8, lazy=args.replay_lazy, latent=args.cls_latent)
+    if len(replay) == 0:
+        raise RuntimeError('the memory is empty : no samples to train the offline classifier on')
+
+    # smaller memories yield smaller batches, as `aqm.sample(128)` did
+    replay_loader = CLDataLoader.batch_loader(replay, min(128, len(replay)), shuffle=True, drop_last=True)
+
+    def batches():
+        while True:
+            for batch in replay_loader: yield batch
+
+    batches = batches()
+
     wait = 0
     wait_for = 10
     best_valid = best_test = -1
@@ -44,32 +69,39 @@ def offline_cls_train(aqm, valid_loader, test_loader, args):
         classifier.train()
 
         for it in range(500):
-            input_x, sample_out = aqm.sample(128)
+            input_x, input_y = [t.to(args.device) for t in next(batches)]
 
             opt.zero_grad()
             logits = classifier(input_x)
-            F.cross_entropy(logits, sample_out['y']).backward()
+            F.cross_entropy(logits, input_y).backward()
             opt.step()
 
-        valid_acc  = eval_cls(classifier, valid_loader, args, name='valid').mean()
+        valid_acc  = eval_cls(classifier, valid_loader, args, name='valid', logger=logger, transform=transform).mean()
 
         if valid_acc > best_valid:
             best_valid = valid_acc
-            best_test  = eval_cls(classifier, test_loader, args, name='test').mean()
+            best_test  = eval_cls(classifier, test_loader, args, name='test', logger=logger, transform=transform).mean()
             wait = 0
         else:
             wait += 1
             if wait >= wait_for: return
 
-        wandb.log({'valid_acc': valid_acc,
-                   'best_valid_acc': best_valid,
-                   'best_test_acc': best_test})
+        logger.log({'valid_acc': valid_acc,
+                    'best_valid_acc': best_valid,
+                    'best_test_acc': best_test})
 
         print('valid acc : {:.4f}\tbest valid : {:.4f}\tbest test : {:.4f}'\
                 .format(valid_acc, best_valid, best_test))
 
 
 
+def run_eval(models, loaders, args, logger, task, epoch):
+    generator = models['generator']
+
+    eval_gen('valid', generator, loaders['valid'], args, max_task=task, epoch=epoch, logger=logger)
+    if task % 2 == 0 or task < 2: eval_drift(generator, loaders['train'], args, logger=logger)
+
+
 # ------------------------------------------------------------------------------
 # Train the model
 # ------------------------------------------------------------------------------
@@ -80,7 +112,8 @@ def main(args):
 
     for run in range(args.n_runs):
         name = 'debug' if args.debug else args.config.split('/')[-1]
-        wandb.init(project='aqm_lite_im', name=name, config={'yaml':config, 'params':args}, reinit=True)
+        logger = get_logger(args, 'aqm_lite_im', name, config={'yaml':config, 'params':args})
+        configure_profiler(args)
 
         # fetch data
         data = locate('utils.data.get_%s' % args.dataset)(args)
@@ -98,6 +131,11 @@ def main(args):
         print("number of generator  parameters:", \
                 sum([np.prod(p.size()) for p in generator.parameters()]))
 
+        loaders   = {'train': train_loader, 'valid': valid_loader}
+        evaluator = None
+        if args.async_eval and not args.debug:
+            evaluator = AsyncEval(run_eval, {'generator': partial(QStack, **config)}, loaders, args, logger)
+
         step = 0
         for task, tr_loader in enumerate(train_loader):
 
@@ -128,7 +166,7 @@ def main(args):
                         generator.optimize(block_outs)
 
                         if (i + 1) % 50 == 0:
-                            generator.log_to_server(wandb)
+                            generator.log_to_server(logger)
 
                     # set the gen. weights used for sampling == current generator weights
                     generator.update_ema_decoder()
@@ -144,6 +182,7 @@ def main(args):
                         )
 
                     step += 1
+                    profiler.step(logger)
 
                 # Test the model
                 # ------------------------------------------------------------------
@@ -152,9 +191,13 @@ def main(args):
                 print(generator._fetch_y_counts()[:, :(task + 1) * args.n_classes_per_task])
                 print(generator.mem_used / generator.data_size)
 
-                if not args.debug:
-                    eval_gen('valid', generator, valid_loader, args, max_task=task, epoch=epoch)
-                    if task % 2 == 0 or task < 2: eval_drift(generator, train_loader, args)
+                if evaluator is not None:
+                    evaluator.submit(step, {'generator': generator}, task=task, epoch=epoch)
+                elif not args.debug:
+                    run_eval({'generator': generator}, loaders, args, logger, task=task, epoch=epoch)
+
+        if evaluator is not None:
+            evaluator.close()
 
         if not args.debug:
             # save model
@@ -165,7 +208,10 @@ def main(args):
             torch.save(generator.state_dict(), save_path)
 
             # for Imagenet Experiments Only
-            offline_cls_train(generator, valid_loader, test_loader, args)
+            offline_cls_train(generator, valid_loader, test_loader, args, logger)
+
+        profiler.close()
+        logger.finish()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,15 @@
+""" Ahead-of-time build of the CUDA chamfer kernels into `build/`, so that no
+    compilation happens when the lidar experiments start.
+
+    python -m lidar.chamfer_distance.build
+"""
+import time
+
+from .chamfer_distance import build_cuda_extension, load_prebuilt
+
+
+if __name__ == '__main__':
+    start = time.time()
+    build_cuda_extension(verbose=True)
+    assert load_prebuilt() is not None, 'the built module could not be loaded'
+    print('built the chamfer kernels in {:.1f}s'.format(time.time() - start))
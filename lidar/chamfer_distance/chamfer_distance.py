@@ -1,11 +1,74 @@
-
+import os
 import torch
+import warnings
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def build_directory():
+    """ `build/<torch>_<cuda>_<python>` : modules built against another torch,
+        CUDA or python ABI are never picked up """
+    import sys
+
+    tag = 'torch{}_cu{}_py{}{}'.format(torch.__version__.split('+')[0], torch.version.cuda,
+                                        *sys.version_info[:2])
+    return os.path.join(HERE, 'build', tag)
+
+
+SOURCES   = [os.path.join(HERE, "chamfer_distance.cpp"),
+             os.path.join(HERE, "chamfer_distance.cu")]
+
+cd = None
+
+def build_cuda_extension(verbose=False):
+    """ compiles the CUDA kernels into `build_directory()`. Run ahead of time
+        with `python -m lidar.chamfer_distance.build` """
+    from torch.utils.cpp_extension import load
+
+    os.makedirs(build_directory(), exist_ok=True)
+    return load(name="cd", build_directory=build_directory(), sources=SOURCES, verbose=verbose)
+
+
+def load_prebuilt():
+    """ the module built by `build_cuda_extension`, if it is newer than the
+        sources and loads. Returns None otherwise """
+    import glob
+    import importlib.util
+
+    sources_mtime = max(os.path.getmtime(src) for src in SOURCES)
+
+    for path in glob.glob(os.path.join(build_directory(), 'cd*.so')):
+        if os.path.getmtime(path) < sources_mtime:
+            continue
+
+        try:
+            spec = importlib.util.spec_from_file_location('cd', path)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+        except (ImportError, OSError) as e:
+            # e.g. undefined symbols, when torch was updated in place
+            warnings.warn('could not load the prebuilt chamfer kernels {} ({})'.format(path, e))
+            continue
+
+        return module
+
+    return None
+
+
+def load_cuda_extension():
+    """ returns the CUDA kernels, loaded on first use only. The prebuilt module
+        is used when up to date and loadable, otherwise the kernels are JIT-compiled """
+    global cd
+
+    if cd is None:
+        cd = load_prebuilt()
+
+    if cd is None:
+        warnings.warn('no usable prebuilt chamfer kernels, compiling them now. '
+                      'Run `python -m lidar.chamfer_distance.build` to do it ahead of time')
+        cd = build_cuda_extension()
+
+    return cd
 
-from torch.utils.cpp_extension import load
-cd = load(name="cd",
-          build_directory='/private/home/lucaspc/repos/aqm-lite/chamfer_distance',
-          sources=["chamfer_distance/chamfer_distance.cpp",
-                   "chamfer_distance/chamfer_distance.cu"])
 
 class ChamferDistanceFunction(torch.autograd.Function):
     @staticmethod
@@ -25,13 +88,170 @@ class ChamferDistanceFunction(torch.autograd.Function):
         dist2 = dist2.cuda()
         idx1 = idx1.cuda()
         idx2 = idx2.cuda()
-        cd.forward_cuda(xyz1, xyz2, dist1, dist2, idx1, idx2)
+        load_cuda_extension().forward_cuda(xyz1, xyz2, dist1, dist2, idx1, idx2)
 
         return dist1, dist2, idx1, idx2
 
 
+@torch.no_grad()
+def chamfer_tiled(xyz1, xyz2, tile=2048):
+    """ device-agnostic chamfer distance. `xyz1` is processed `tile` points at
+        a time, so memory is bounded by (B, tile, m) distances. The minima over
+        `xyz1` (i.e. for every point of `xyz2`) are kept as running minima.
+
+        Returns squared distances and nearest neighbour indices, as the CUDA kernels """
+
+    B, n, _ = xyz1.size()
+    _, m, _ = xyz2.size()
+
+    dist1 = xyz1.new_empty(B, n)
+    idx1  = torch.empty(B, n, dtype=torch.long, device=xyz1.device)
+    dist2 = xyz1.new_full((B, m), float('inf'))
+    idx2  = torch.zeros(B, m, dtype=torch.long, device=xyz1.device)
+
+    for start in range(0, n, tile):
+        end = min(n, start + tile)
+
+        dist = torch.cdist(xyz1[:, start:end], xyz2).pow_(2)   # (B, tile, m)
+
+        dist1[:, start:end], idx1[:, start:end] = dist.min(2)
+
+        tile_min, tile_idx = dist.min(1)                      # (B, m)
+        closer = tile_min < dist2
+        dist2  = torch.where(closer, tile_min, dist2)
+        idx2   = torch.where(closer, tile_idx + start, idx2)
+
+    return dist1, dist2, idx1.int(), idx2.int()
+
+
+@torch.no_grad()
+def chamfer_kdtree(xyz1, xyz2):
+    """ CPU chamfer distance using k-d trees (requires scipy) """
+    from scipy.spatial import cKDTree
+
+    out = [[], [], [], []]
+    for a, b in zip(xyz1.cpu().double().numpy(), xyz2.cpu().double().numpy()):
+        d1, i1 = cKDTree(b).query(a, k=1)
+        d2, i2 = cKDTree(a).query(b, k=1)
+
+        for container, value in zip(out, (d1 ** 2, d2 ** 2, i1, i2)):
+            container += [torch.from_numpy(value)]
+
+    dist1, dist2, idx1, idx2 = [torch.stack(x).to(xyz1.device) for x in out]
+
+    return dist1.to(xyz1.dtype), dist2.to(xyz1.dtype), idx1.int(), idx2.int()
+
+
+@torch.no_grad()
+def chamfer_tiled_one_to_many(ref, others, tile=2048):
+    """ `chamfer_tiled` of one reference (B, n, 3) against M clouds (M, B, m, 3).
+        All clouds are scored in the same pass over the reference tiles """
+
+    M, B, m, _ = others.size()
+    n = ref.size(1)
+
+    # (B, M * m, 3): every reference tile is compared to all clouds at once
+    others = others.permute(1, 0, 2, 3).reshape(B, M * m, 3)
+    tile = max(1, tile // M)
+
+    dist1 = ref.new_empty(B, n, M)
+    dist2 = ref.new_full((B, M * m), float('inf'))
+
+    for start in range(0, n, tile):
+        end = min(n, start + tile)
+
+        dist = torch.cdist(ref[:, start:end], others).pow_(2)   # (B, tile, M * m)
+
+        dist1[:, start:end] = dist.view(B, end - start, M, m).min(-1)[0]
+        dist2 = torch.min(dist2, dist.min(1)[0])
+
+    return dist1.permute(2, 0, 1), dist2.view(B, M, m).transpose(0, 1)
+
+
+@torch.no_grad()
+def chamfer_kdtree_one_to_many(ref, others):
+    """ `chamfer_kdtree` of one reference (B, n, 3) against M clouds (M, B, m, 3).
+        The reference trees are only built once """
+    from scipy.spatial import cKDTree
+
+    M, B = others.shape[:2]
+    ref_np, others_np = ref.cpu().double().numpy(), others.cpu().double().numpy()
+
+    dist1 = torch.zeros(M, B, ref.size(1), dtype=torch.float64)
+    dist2 = torch.zeros(M, B, others.size(2), dtype=torch.float64)
+
+    for b in range(B):
+        ref_tree = cKDTree(ref_np[b])
+        for i in range(M):
+            dist1[i, b] = torch.from_numpy(cKDTree(others_np[i, b]).query(ref_np[b], k=1)[0] ** 2)
+            dist2[i, b] = torch.from_numpy(ref_tree.query(others_np[i, b], k=1)[0] ** 2)
+
+    return dist1.to(ref.device, ref.dtype), dist2.to(ref.device, ref.dtype)
+
+
+def has_scipy():
+    try:
+        import scipy.spatial
+        return True
+    except ImportError:
+        return False
 
 
 class ChamferDistance(torch.nn.Module):
+    """ backend : `cuda` (custom kernels), `tiled` (chunked brute force, runs on
+                  any device), `kdtree` (CPU, requires scipy) or `auto`.
+                  `auto` uses the CUDA kernels for CUDA inputs when they can be
+                  built, k-d trees for CPU inputs when scipy is installed, and
+                  the tiled engine otherwise """
+
+    def __init__(self, backend='auto', tile=2048):
+        super().__init__()
+        assert backend in ['auto', 'cuda', 'tiled', 'kdtree']
+
+        self.backend = backend
+        self.tile = tile
+        self.cuda_ok = None
+
+    def get_backend(self, xyz):
+        if self.backend != 'auto':
+            return self.backend
+
+        if not xyz.is_cuda:
+            return 'kdtree' if has_scipy() else 'tiled'
+
+        if self.cuda_ok is None:
+            try:
+                load_cuda_extension()
+                self.cuda_ok = True
+            except Exception as e:
+                warnings.warn('could not build the CUDA chamfer kernels ({}), '
+                              'falling back to the tiled engine'.format(e))
+                self.cuda_ok = False
+
+        return 'cuda' if self.cuda_ok else 'tiled'
+
     def forward(self, xyz1, xyz2):
-        return ChamferDistanceFunction.apply(xyz1, xyz2)
+        backend = self.get_backend(xyz1)
+
+        if backend == 'cuda':
+            return ChamferDistanceFunction.apply(xyz1, xyz2)
+        elif backend == 'kdtree':
+            return chamfer_kdtree(xyz1, xyz2)
+
+        return chamfer_tiled(xyz1, xyz2, tile=self.tile)
+
+    def one_to_many(self, ref, others):
+        """ distances between a reference (B, n, 3) and M clouds (M, B, m, 3).
+            Returns squared distances of shape (M, B, n) and (M, B, m) """
+
+        backend = self.get_backend(ref)
+
+        if backend == 'cuda':
+            M, B = others.shape[:2]
+            ref_ = ref.unsqueeze(0).expand(M, *ref.shape).reshape(M * B, *ref.shape[1:])
+            dist1, dist2 = ChamferDistanceFunction.apply(ref_, others.reshape(M * B, *others.shape[2:]))[:2]
+            return dist1.view(M, B, -1), dist2.view(M, B, -1)
+        elif backend == 'kdtree':
+            return chamfer_kdtree_one_to_many(ref, others)
+
+        return chamfer_tiled_one_to_many(ref, others, tile=self.tile)
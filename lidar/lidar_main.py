@@ -1,14 +1,13 @@
 import sys
 import pdb
 import yaml
-import wandb
 import numpy as np
 from os.path import join
 from pydoc  import locate
 from copy   import deepcopy
+from functools import partial
 from collections import defaultdict
 from torch.nn import functional as F
-from torchvision.utils import save_image, make_grid
 
 sys.path += ['../']
 
@@ -17,6 +16,9 @@ from utils.data   import *
 from utils.buffer import *
 from utils.utils  import dotdict, get_chamfer, load_model
 from utils.args   import get_args
+from utils.logger import get_logger
+from utils.profiling import profiler, configure_profiler
+from utils.async_eval import AsyncEval
 
 from common.modular import QStack
 from common.model   import ResNet18
@@ -25,67 +27,137 @@ np.set_printoptions(threshold=3)
 
 Mean = lambda x : sum(x) / len(x)
 rescale_inv = (lambda x : x * 0.5 + 0.5)
-chamfer = get_chamfer()
 
 best_test = float('inf')
 
-@torch.no_grad()
-def img_compress(block_outs, data, ext='PNG'):
+def remap_codes(argmin):
+    """ (B, N, H, W) codebook indices --> rank of every index among the indices
+        used by its sample. Returns the remapped maps and the amount used """
+
+    B = argmin.size(0)
+
+    # offset the indices of every sample, so a single `unique` handles the batch
+    offset = int(argmin.max()) + 1
+    keys   = argmin + torch.arange(B, device=argmin.device).view(-1, 1, 1, 1) * offset
+
+    used, inverse = keys.unique(return_inverse=True)
+    first = torch.searchsorted(used, torch.arange(B, device=argmin.device) * offset)
+    n_used = torch.cat((first[1:], first.new_full((1,), used.size(0)))) - first
+
+    return inverse - first.view(-1, 1, 1, 1), n_used
+
+
+def encode_png(codes, n_used, ext='PNG', **kwargs):
     from io import BytesIO
     from PIL import Image
 
-    logs = {i:[] for i in block_outs.keys()}
+    # up to 4 codebooks are stored as channels (L, LA, RGB, RGBA), stacked vertically otherwise
+    if codes.shape[0] <= 4:
+        codes = codes.transpose(1, 2, 0)
+        codes = codes[..., 0] if codes.shape[-1] == 1 else codes
+    else:
+        codes = codes.reshape(-1, codes.shape[-1])
 
-    for block_id in block_outs.keys():
-        argmins = block_outs[block_id]['argmin']
+    buffer = BytesIO()
+    Image.fromarray(codes.astype('uint8')).save(buffer, ext, **kwargs)
+    return buffer.getbuffer().nbytes
+
+
+def encode_zlib(codes, n_used):
+    """ packs every index on ceil(log2(n_used)) bits, then deflates """
+    import zlib
+
+    n_bits = max(1, int(np.ceil(np.log2(max(n_used, 2)))))
+    bits   = (codes.reshape(-1, 1) >> np.arange(n_bits)) & 1
 
-        for argmin in argmins:
+    return len(zlib.compress(np.packbits(bits.astype('uint8')).tobytes(), 9))
 
-            new_argmin = []
-            for argmin_ in argmin:
-                used = argmin.unique()
 
-                cp = argmin_.clone()
-                for i in range(used.size(0)):
-                    argmin_[cp == used[i]] = i
+CODECS = {
+    'png'  : encode_png,
+    'webp' : lambda codes, n_used : encode_png(codes, n_used, ext='WEBP', lossless=True),
+    'zlib' : encode_zlib,
+}
 
-                new_argmin += [argmin_]
 
-            new_argmin = torch.stack(new_argmin)
+@torch.no_grad()
+def img_compress(block_outs, data, codec='png', n_threads=8):
+    """ average amount of bytes needed to send the code map of a sample, per block.
+        All maps of the batch are encoded in parallel """
+    from concurrent.futures import ThreadPoolExecutor
+
+    encode = CODECS[codec]
+    maps   = []
+
+    for block_id in block_outs.keys():
+        codes, n_used = remap_codes(block_outs[block_id]['argmin'])
+        codes, n_used = codes.cpu().numpy(), n_used.tolist()
 
-            buffer = BytesIO()
-            im = Image.fromarray(new_argmin.permute(1,2,0).cpu().data.numpy().squeeze().astype('uint8'))
-            im.save(buffer, ext)
-            n_bytes = buffer.getbuffer().nbytes
+        maps += [(block_id, codes_, n_used_) for codes_, n_used_ in zip(codes, n_used)]
 
-            logs[block_id] += [n_bytes]
+    with ThreadPoolExecutor(n_threads) as pool:
+        n_bytes = list(pool.map(lambda m : encode(m[1], m[2]), maps))
 
+    logs = {i:[] for i in block_outs.keys()}
+    for (block_id, _, _), n_bytes_ in zip(maps, n_bytes):
+        logs[block_id] += [n_bytes_]
 
     return {i:Mean(logs[i]) for i in logs.keys()}
 
 
 @torch.no_grad()
 def check_comp(block_outs, data_raw, loader, th=0.15):
+    """ scores the reconstructions of all blocks against `data_raw` in a single
+        call. Returns, for every sample, the id of the most compressed block
+        with an error under `th` (0 if there is none) and that error """
 
     # normalize point cloud
     max_ = data_raw.reshape(data_raw.size(0), -1).abs().max(dim=1)[0].view(-1, 1, 1, 1)
-    data = data_raw / max_
 
-    comp = torch.cuda.LongTensor(data_raw.size(0)).fill_(0)
-    err  = torch.cuda.FloatTensor(comp.size(0)).fill_(0)
+    block_ids = sorted(block_outs.keys())
+    recons    = torch.stack([block_outs[block_id]['x_final'] for block_id in block_ids]) * max_
 
-    for block_id in block_outs.keys():
-        block_out = block_outs[block_id]
+    dist_a, dist_b = get_chamfer(one_to_many=True)(data_raw, recons)
+    snnrmse = (.5 * dist_a.mean(-1) + .5 * dist_b.mean(-1)).sqrt()   # (n_blocks, B)
 
-        dist_a, dist_b  = chamfer(data_raw, block_out['x_final'] * max_)
-        snnrmse = (.5 * dist_a.mean(-1) + .5 * dist_b.mean(-1)).sqrt()
+    # the last (most compressed) valid block wins. 0 == no valid block
+    rank   = torch.arange(1, len(block_ids) + 1, device=snnrmse.device).view(-1, 1)
+    winner = ((snnrmse < th).long() * rank).max(0)[0]
+    valid  = winner > 0
 
-        comp[snnrmse < th] = block_id
-        err[snnrmse < th]  = snnrmse[snnrmse < th]
+    block_ids = torch.LongTensor([0] + block_ids).to(snnrmse.device)
+    comp = block_ids[winner]
+    err  = snnrmse.gather(0, (winner - 1).clamp(min=0).unsqueeze(0)).squeeze(0) * valid.float()
 
     return comp, err
 
 
+def bytes_sent(generator, coders, block_outs, bid):
+    """ bytes needed to send the selected code maps of a batch. Blocks with a
+        `KeyframeCoder` send sparse deltas w.r.t. their last keyframe """
+
+    counts  = bid.bincount(minlength=len(generator.all_blocks))
+    n_bytes = 0.
+
+    for block in generator.all_blocks:
+        if block.id in coders:
+            coder = coders[block.id]
+            maps  = block_outs[block.id]['argmin'][bid == block.id]
+            n_bytes += sum(coder.cost(is_key, 0 if changed is None else changed.size(0))
+                                for is_key, changed, _ in coder.encode(maps))
+        else:
+            n_bytes += generator.mem_per_block[block.id].item() * counts[block.id].item()
+
+    return n_bytes
+
+
+def run_eval(models, loaders, args, logger, task, epoch):
+    generator = models['generator']
+
+    eval_gen_lidar('valid', generator, loaders['valid'], args, max_task=task, epoch=epoch, logger=logger)
+    if task % 2 == 0 or task < 2: eval_drift(generator, loaders['train'], args, logger=logger)
+
+
 # ------------------------------------------------------------------------------
 # Train the model
 # ------------------------------------------------------------------------------
@@ -99,7 +171,8 @@ def main(args):
     config = yaml.load(open(args.config), Loader=yaml.FullLoader)
 
     for run in range(args.n_runs):
-        wandb.init(project='aqm_lidar_%s' % suffix[mode], name=args.name, config={'yaml':config, 'params':args}, reinit=True)
+        logger = get_logger(args, 'aqm_lidar_%s' % suffix[mode], args.name, config={'yaml':config, 'params':args})
+        configure_profiler(args)
 
         # fetch data
         data = locate('utils.data.get_%s' % args.dataset)(args, mode=mode)
@@ -122,9 +195,20 @@ def main(args):
         print("number of generator  parameters:", \
                 sum([np.prod(p.size()) for p in generator.parameters()]))
 
+        loaders   = {'train': train_loader, 'valid': valid_loader}
+        evaluator = None
+        if args.async_eval and not args.debug:
+            evaluator = AsyncEval(run_eval, {'generator': partial(QStack, **config)}, loaders, args, logger)
+
         step = 0
 
-        counts = torch.cuda.LongTensor(len(generator.all_blocks)).fill_(0)
+        counts = torch.zeros(len(generator.all_blocks), dtype=torch.long, device=args.device)
+
+        # inter-frame coding of the sent code maps, for blocks using it
+        coders = {block.id : KeyframeCoder(block.buffer.input_size, block.buffer.max_idx,
+                                           block.buffer.keyframe_interval)
+                    for block in generator.blocks if block.buffer.keyframe_interval > 0}
+        delta_sent = 0.
 
         for task, tr_loader in enumerate(train_loader):
             print('dataset has %d examples' % len(tr_loader))
@@ -140,11 +224,13 @@ def main(args):
                     if sample_amt > args.samples_per_task > 0: break
                     sample_amt += input_x_raw.size(0)
 
+                    # histogram equalization is done on the whole batch, on device
+                    input_x_raw = tr_loader.dataset.equalize(input_x_raw.to(args.device))
+
                     # normalize point cloud
                     max_    = input_x_raw.reshape(input_x_raw.size(0), -1).abs().max(dim=1)[0].view(-1, 1, 1, 1)
                     input_x = input_x_raw / max_
 
-                    input_x = input_x.to(args.device)
                     input_y = input_y.to(args.device)
                     idx_    = idx_.to(args.device)
 
@@ -160,24 +246,30 @@ def main(args):
                         generator.optimize(block_outs)
 
                         if mode == 'online' and n_iter == 0:
-                            bid, err = check_comp(block_outs, input_x_raw.to(args.device), tr_loader, th=0.15)
+                            bid, err = check_comp(block_outs, input_x_raw, tr_loader, th=0.15)
                             counts += bid.bincount(minlength=counts.size(0))
 
+                            if len(coders) > 0:
+                                delta_sent += bytes_sent(generator, coders, block_outs, bid)
+
                         if (i + 1) % (500 // args.batch_size) == 0 and n_iter == 0:
 
                             if mode == 'online':
-                                wandb.log({'bytes sent': (generator.mem_per_block * counts).sum().item()})
+                                logger.log({'bytes sent': (generator.mem_per_block * counts).sum().item()})
 
-                                byte_count = img_compress(block_outs, input_x_raw)
-                                wandb.log({'png bytes sent':
+                                byte_count = img_compress(block_outs, input_x_raw, codec=args.img_codec)
+                                logger.log({'%s bytes sent' % args.img_codec:
                                     (generator.mem_per_block[0] * counts[0]).sum().item() +
                                     sum(byte_count[i] * counts[i].item() for i in byte_count.keys()),
                                             'bytes sent':
                                     (generator.mem_per_block * counts).sum().item()
                                     })
-                                wandb.log({'count_%d' % i : counts[i].item() for i in range(len(counts))})
+                                logger.log({'count_%d' % i : counts[i].item() for i in range(len(counts))})
 
-                            generator.log_to_server(wandb)
+                                if len(coders) > 0:
+                                    logger.log({'delta bytes sent': delta_sent})
+
+                            generator.log_to_server(logger)
 
                     # set the gen. weights used for sampling == current generator weights
                     generator.update_ema_decoder()
@@ -193,6 +285,7 @@ def main(args):
                         )
 
                     step += 1
+                    profiler.step(logger)
 
                 # Test the model
                 # ------------------------------------------------------------------
@@ -204,9 +297,10 @@ def main(args):
                     xx = torch.stack([input_x] + [ block_outs[k]['x_final'] for k in sorted(block_outs.keys())] )
                     np.save(open('lidars/%s' % name , 'wb'), xx.cpu().data.numpy(), allow_pickle=False)
 
-                if not args.debug:
-                    eval_gen_lidar('valid', generator, valid_loader, args, max_task=task, epoch=epoch)
-                    if task % 2 == 0 or task < 2: eval_drift(generator, train_loader, args)
+                if evaluator is not None:
+                    evaluator.submit(step, {'generator': generator}, task=task, epoch=epoch)
+                elif not args.debug:
+                    run_eval({'generator': generator}, loaders, args, logger, task=task, epoch=epoch)
 
                 if not args.debug and (epoch + 1) % 10 == 0:
                     # save model
@@ -217,6 +311,11 @@ def main(args):
                     save_path = os.path.join('/checkpoint/lucaspc/aqm/', name, 'gen_%d.pth' % epoch)
                     torch.save(generator.state_dict(), save_path)
 
+        if evaluator is not None:
+            evaluator.close()
+
+        profiler.close()
+        logger.finish()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,98 @@
+import os
+import sys
+import pdb
+import yaml
+import numpy as np
+from collections import defaultdict
+
+from utils.data   import *
+from utils.buffer import *
+from utils.utils  import dotdict
+from utils.args   import get_args
+from utils.logger import get_logger
+from utils.profiling import profiler, configure_profiler
+from utils.stream import StreamDataset, get_source
+
+from common.modular import QStack
+
+np.set_printoptions(threshold=3)
+
+
+# ------------------------------------------------------------------------------
+# Train the model on an (unbounded) stream
+# ------------------------------------------------------------------------------
+def main(args):
+    if type(args) == dict: args = dotdict(args)
+
+    config = yaml.load(open(args.config), Loader=yaml.FullLoader)
+
+    name = 'debug' if args.debug else args.config.split('/')[-1]
+    logger = get_logger(args, 'aqm_stream', name, config={'yaml':config, 'params':args})
+    configure_profiler(args)
+
+    # incoming data is read on a background thread, with bounded memory
+    stream = StreamDataset(get_source(args), args.batch_size, max_queue=args.stream_queue)
+
+    generator = QStack(**config).to(args.device)
+    print(generator)
+
+    seen_tasks = set()
+    prev_task  = None
+
+    for step, (input_x, input_y, task, idx_) in enumerate(stream):
+        if step % 5 == 0 : print('  ', step, end='\r')
+
+        # task boundary
+        if prev_task is not None and task != prev_task:
+            generator.update_ema_decoder()
+            print(generator._fetch_y_counts())
+            print(generator.mem_used / generator.data_size)
+
+        seen_tasks.add(task)
+        prev_task = task
+
+        input_x = input_x.to(args.device)
+        input_y = input_y.to(args.device)
+        idx_    = idx_.to(args.device)
+
+        for n_iter in range(args.n_iters):
+
+            sample_outs = re_x = None
+            if len(seen_tasks) > 1 and args.rehearsal:
+                re_x, sample_outs = \
+                        generator.sample(args.buffer_batch_size, exclude_task=task)
+
+            out, block_outs = generator(input_x, x_re=re_x)
+            generator.optimize(block_outs)
+
+            if (step + 1) % 50 == 0:
+                generator.log_to_server(logger)
+
+        # set the gen. weights used for sampling == current generator weights
+        generator.update_ema_decoder()
+        generator.track()
+
+        if args.rehearsal:
+            generator.add_reservoir(
+                    input_x,
+                    {'y': input_y, 't': task, 'bidx': idx_, 'step': step},
+                    block_outs,
+                    sample_x=re_x,
+                    sample_add_info=sample_outs
+            )
+
+        profiler.step(logger)
+
+    if not args.debug:
+        # save model
+        os.makedirs('/checkpoint/lucaspc/aqm/' + args.name, exist_ok=True)
+        save_path = os.path.join('/checkpoint/lucaspc/aqm/', args.name, 'gen_stream.pth')
+        torch.save(generator.state_dict(), save_path)
+
+    profiler.close()
+    logger.finish()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    main(args)
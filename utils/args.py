@@ -14,6 +14,9 @@ def get_global_args():
     # Data and training settings
     add('--data_folder', type=str, default="../cl-pytorch/data",
             help='Location of data (will download data if does not exist)')
+    add('--cache_dir', type=str, default=None,
+            help='Location of preprocessed datasets. Defaults to '            +
+            '`data_folder/cache`')
     add('--run_dir', type=str, default='runs',
             help='base directory in which all experiment logs will be held')
     add('--dataset', type=str, default='split_cifar10',
@@ -30,6 +33,13 @@ def get_global_args():
             'buffer_batch_size equal to batch_size')
     add('--num_epochs', type=int, default=1,
             help='number of epochs per task. Use 1 for online learning')
+    add('--num_workers', type=int, default=8,
+            help='number of DataLoader worker processes per task loader')
+    add('--prefetch_factor', type=int, default=2,
+            help='number of batches prefetched by every DataLoader worker')
+    add('--persistent_workers', action='store_true',
+            help='keep DataLoader workers alive between epochs. Best used '   +
+            'when there are few task loaders (e.g. kitti)')
     add('--device', type=str, default='cuda')
     add('--name', type=str, default='test')
 
@@ -48,9 +58,35 @@ def get_global_args():
             'Will only be used if `--override_cl_defaults`')
 
 
+    # Streaming (see `stream_main.py`)
+    add('--stream_dir', type=str, default=None,
+            help='folder watched for incoming records')
+    add('--stream_keep', action='store_true',
+            help='keep the records of `--stream_dir` once read (they are deleted by default)')
+    add('--stream_port', type=int, default=None,
+            help='local port on which incoming records are received')
+    add('--stream_queue', type=int, default=16,
+            help='max amount of incoming batches held in memory')
+    add('--stream_timeout', type=float, default=None,
+            help='stop once no record arrived for this many seconds. '        +
+            'Use the default (None) for unbounded streams')
+
+
     # Misc
     add('--seed', type=int, default=521)
     add('--debug', action='store_true')
+    add('--async_eval', action='store_true',
+            help='run the evaluations in a separate process, on snapshots of the models')
+    add('--logger', type=str, default='local', choices=['local', 'wandb', 'none'],
+            help='metrics backend : local JSONL files (see `--log_dir`), wandb, or nothing')
+    add('--log_dir', type=str, default='logs',
+            help='root folder of the local logs')
+    add('--profile', type=int, default=0,
+            help='> 0 : log the per-stage times and the memory usage every `profile` steps')
+    add('--profile_sync', action='store_true',
+            help='synchronize CUDA around every profiled stage, for exact stage times')
+    add('--profile_trace', type=int, nargs=2, default=None, metavar=('START', 'N_STEPS'),
+            help='capture a torch.profiler trace of N_STEPS steps from step START (needs `--profile`)')
 
 
     # From old repo
@@ -74,11 +110,23 @@ def get_global_args():
             help='learning rate for the classifier')
     add('--cls_n_iters', type=int, default=1,
             help='number of iterations on the incoming data for the classifier')
+    add('--cls_latent', type=int, default=0,
+            help='train the classifier on the `z_q` of this block instead of images (0 == images)')
+    add('--eval_bs', type=int, default=1024,
+            help='largest batch size used to evaluate the classifier (reduced if it does not fit)')
+    add('--fold_bn', action='store_true',
+            help='fold the batchnorms of the classifier into its convolutions when evaluating')
+    add('--replay_uint8', action='store_true',
+            help='store the decoded memory as uint8 when training a classifier offline')
+    add('--replay_lazy', action='store_true',
+            help='decode the memory on request (with a cache) instead of all at once')
 
     add('--config', type=str, default='config/cifar_20.yaml')
     add('--gen_weights', type=str, default=None)
 
     add('--mode', type=str, default='offline', choices=['online', 'offline'])
+    add('--img_codec', type=str, default='png', choices=['png', 'webp', 'zlib'],
+            help='lossless codec used to measure the bytes sent in online lidar mode')
 
     return parser.parse_args()
 
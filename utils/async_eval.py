@@ -0,0 +1,199 @@
+import queue
+import traceback
+import torch
+import torch.multiprocessing as mp
+
+from utils.utils import load_state
+
+""" Evaluation in a separate process.
+
+    The training loop only pays for a snapshot of the models, i.e. a copy of
+    their state in shared memory. A worker process rebuilds the models from the
+    snapshots and runs
+
+        fn(models, loaders, args, logger, **kwargs)
+
+    where `models` maps names to the rebuilt models and `logger` has the
+    `log` / `Image` interface of `utils.logger`, expected by `eval.py`.
+    Everything logged is sent back to the main process, and logged there with
+    the step at which the snapshot was taken.
+"""
+
+
+# Snapshots
+# ---------------------------------------------------------------------------------
+
+@torch.no_grad()
+def snapshot(model):
+    """ copies the state of `model` to shared memory. Also keeps the flags
+        which are not part of the state dict """
+
+    state = {name: value.detach().to('cpu', copy=True).share_memory_()
+                for name, value in model.state_dict().items()}
+
+    flags = {'training': model.training,
+             'frozen_qt': [block.frozen_qt for block in getattr(model, 'blocks', [])
+                                if hasattr(block, 'frozen_qt')]}
+
+    return state, flags
+
+
+def restore(build, state, flags, device):
+    model = build()
+
+    if len(flags['frozen_qt']) > 0:
+        # QStack : buffers and codebooks need to be resized
+        load_state(model, state)
+        for block, frozen in zip(model.blocks, flags['frozen_qt']):
+            block.frozen_qt = frozen
+    else:
+        model.load_state_dict(state)
+
+    return model.to(device).train(flags['training'])
+
+
+# Logging
+# ---------------------------------------------------------------------------------
+
+class ImageRecord(object):
+    """ stands for a `logger.Image` until it reaches the main process """
+
+    def __init__(self, data, caption=None):
+        self.data    = data.cpu() if isinstance(data, torch.Tensor) else data
+        self.caption = caption
+
+
+class QueueLogger(object):
+    """ forwards everything logged in the worker to the main process """
+
+    Image = ImageRecord
+
+    def __init__(self, results, step):
+        self.results = results
+        self.step    = step
+
+    def log(self, values):
+        values = {key: value.item() if isinstance(value, torch.Tensor) and value.numel() == 1 else value
+                    for key, value in values.items()}
+        self.results.put((self.step, 'log', values))
+
+
+def to_logger(values, step, logger):
+    """ rebuilds the images with `logger` and adds the step of the snapshot """
+
+    convert = lambda x : logger.Image(x.data, caption=x.caption) if isinstance(x, ImageRecord) else x
+
+    values = {key: [convert(x) for x in value] if isinstance(value, list) else convert(value)
+                for key, value in values.items()}
+    values['eval_step'] = step
+
+    return values
+
+
+# Worker
+# ---------------------------------------------------------------------------------
+
+def worker(jobs, results, fn, builders, loaders, args):
+    while True:
+        job = jobs.get()
+        if job is None: break
+
+        step, snapshots, kwargs = job
+
+        try:
+            models = {name: restore(builders[name], *snapshots[name], args.device)
+                        for name in snapshots.keys()}
+            del snapshots
+
+            out = fn(models, loaders, args, QueueLogger(results, step), **kwargs)
+            results.put((step, 'done', out))
+        except Exception:
+            results.put((step, 'error', traceback.format_exc()))
+
+
+class AsyncEval(object):
+    """ fn       : eval function (see above). Must be importable (module level)
+        builders : name --> picklable callable building a fresh model
+        loaders  : passed as is to `fn`
+
+        At most `max_pending` snapshots wait for the worker. When the worker
+        falls behind, `submit` blocks (this bounds the memory used). While
+        blocked, the worker is checked every `timeout` seconds : if it died
+        (e.g. killed when out of memory), a `RuntimeError` is raised """
+
+    def __init__(self, fn, builders, loaders, args, logger, max_pending=2, timeout=5.):
+        ctx = mp.get_context('spawn')
+
+        self.logger  = logger
+        self.timeout = timeout
+        self.jobs    = ctx.Queue(max_pending)
+        self.results = ctx.Queue()
+
+        # snapshots must outlive their transfer to the worker
+        self.pending  = {}
+        self.finished = []
+
+        self.process = ctx.Process(target=worker,
+                            args=(self.jobs, self.results, fn, builders, loaders, args))
+        self.process.start()
+
+    def submit(self, step, models, **kwargs):
+        """ models : name --> model to snapshot. `kwargs` are passed to `fn` """
+
+        self.receive()
+
+        snapshots = {name: snapshot(model) for name, model in models.items()}
+        self.pending[step] = snapshots
+        self.put((step, snapshots, kwargs))
+
+    def check_alive(self):
+        if not self.process.is_alive():
+            raise RuntimeError('the evaluation worker exited (code %s) with the evaluation of steps %s pending'
+                                    % (self.process.exitcode, sorted(self.pending.keys())))
+
+    def put(self, job):
+        while True:
+            self.check_alive()
+            try:
+                return self.jobs.put(job, timeout=self.timeout)
+            except queue.Full:
+                pass
+
+    def receive(self, block=False):
+        """ logs what the worker sent so far """
+
+        while len(self.pending) > 0:
+            try:
+                step, kind, value = self.results.get(block=block, timeout=self.timeout if block else None)
+            except queue.Empty:
+                if not block: break
+
+                self.check_alive()
+                continue
+
+            if kind == 'log':
+                self.logger.log(to_logger(value, step, self.logger))
+            elif kind == 'error':
+                raise RuntimeError('evaluation of step %s failed :\n%s' % (step, value))
+            else:
+                del self.pending[step]
+                self.finished += [(step, value)]
+
+    def poll(self):
+        """ returns the (step, output of `fn`) of the evaluations finished
+            since the last call """
+
+        self.receive()
+
+        finished, self.finished = self.finished, []
+        return finished
+
+    def close(self):
+        """ waits for all the submitted evaluations """
+
+        self.receive(block=True)
+
+        self.put(None)
+        self.process.join()
+
+        return self.poll()
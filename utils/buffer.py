@@ -5,15 +5,87 @@ import numpy as np
 import torch.nn as nn
 import torch.nn.functional as F
 
+from utils.profiling import profiled
+
+class KeyframeCoder(object):
+    """ codes a sequence of code maps as keyframes, and sparse deltas (changed
+        positions and their new values) w.r.t the last keyframe.
+
+        A new keyframe is started every `interval` maps, or when the delta
+        would cost more than the map itself (e.g. a scene change) """
+
+    def __init__(self, input_size, max_idx, interval):
+        self.input_size = input_size
+        self.interval   = interval
+        self.numel      = int(np.prod(input_size))
+        self.reset()
+        self.adjust_n_embeds(max_idx)
+
+    def reset(self):
+        self.key, self.since_key = None, 0
+
+    def adjust_n_embeds(self, max_idx):
+        # in bytes, as `Buffer.mem_per_sample`
+        self.key_cost   = self.numel * np.log2(max_idx) / np.log2(256.)
+        self.entry_cost = (np.log2(self.numel) + np.log2(max_idx)) / np.log2(256.)
+
+    def cost(self, is_key, n_changed):
+        return self.key_cost if is_key else n_changed * self.entry_cost
+
+    @torch.no_grad()
+    def encode(self, x):
+        """ x : (B, *input_size) maps, in stream order.
+            returns a list of (is_key, changed positions, new values) """
+
+        out = []
+        for x_ in x.reshape(x.size(0), self.numel):
+            if self.key is not None and self.since_key < self.interval:
+                changed = (x_ != self.key).nonzero().squeeze(1)
+
+                if self.cost(False, changed.size(0)) < self.key_cost:
+                    self.since_key += 1
+                    out += [(False, changed, x_[changed])]
+                    continue
+
+            self.key, self.since_key = x_, 1
+            out += [(True, None, None)]
+
+        return out
+
+
 class Buffer(nn.Module):
-    def __init__(self, input_size, n_classes, max_idx=256., amt=0, dtype=torch.LongTensor):
+    """ `keyframe_interval` > 0 enables inter-frame coding of the (code map)
+        samples : every sample is stored as a sparse delta against a keyframe
+        of the same buffer. `bx` then holds (keyframe uid, sample uid) handles,
+        and keyframes are dropped once no sample refers to them """
+
+    DELTA_BUFFERS = ['bkeys', 'bkey_uid', 'bdelta_owner', 'bdelta_pos', 'bdelta_val']
+
+    def __init__(self, input_size, n_classes, max_idx=256., amt=0, dtype=torch.LongTensor, keyframe_interval=0):
         super().__init__()
 
         self.input_size = input_size
         self.n_classes  = n_classes
         self.dtype      = dtype
+        self.max_idx    = max_idx
+        self.keyframe_interval = keyframe_interval
+
+        if keyframe_interval > 0:
+            self.coder    = KeyframeCoder(input_size, max_idx, keyframe_interval)
+            self.next_uid = amt
+            self.key_uid  = -1
+
+            # every sample is its own keyframe
+            bx = torch.arange(amt).view(-1, 1).repeat(1, 2)
+
+            self.register_buffer('bkeys', torch.LongTensor(amt, self.coder.numel).fill_(0))
+            self.register_buffer('bkey_uid', torch.arange(amt))
+            self.register_buffer('bdelta_owner', torch.LongTensor(0))
+            self.register_buffer('bdelta_pos', torch.LongTensor(0))
+            self.register_buffer('bdelta_val', torch.LongTensor(0))
+        else:
+            bx = dtype(amt, *input_size).fill_(0)
 
-        bx    = dtype(amt, *input_size).fill_(0)
         by    = torch.LongTensor(amt).fill_(0)
         bt    = torch.LongTensor(amt).fill_(0)
         bidx  = torch.LongTensor(amt).fill_(0)
@@ -21,7 +93,6 @@ class Buffer(nn.Module):
 
         self.n_samples = amt
         self.mem_per_sample = np.prod(input_size) * np.log2(max_idx) / np.log2(256.)
-        self.n_memory  = amt * self.mem_per_sample
 
         self.register_buffer('bx', bx)
         self.register_buffer('by', by)
@@ -29,17 +100,114 @@ class Buffer(nn.Module):
         self.register_buffer('bidx', bidx)
         self.register_buffer('bstep', bstep)
 
+        self.n_memory = self.memory()
+
         self.to_one_hot  = lambda x : x.new(x.size(0), n_classes).fill_(0).scatter_(1, x.unsqueeze(1), 1)
         self.arange_like = lambda x : torch.arange(x.size(0)).to(x.device)
         self.shuffle     = lambda x : x[torch.randperm(x.size(0))]
 
     def expand(self, amt):
         """ used when loading a model from `pth` file and the amt of samples in the buffer don't align """
-        self.__init__(self.input_size, self.n_classes, dtype=self.dtype, amt=amt)
+        self.__init__(self.input_size, self.n_classes, max_idx=self.max_idx, dtype=self.dtype, amt=amt,
+                      keyframe_interval=self.keyframe_interval)
+
+    def memory(self):
+        """ memory used, in bytes """
+        if self.keyframe_interval > 0:
+            return self.bkeys.size(0) * self.mem_per_sample + \
+                   self.bdelta_pos.size(0) * self.coder.entry_cost
+
+        return self.n_samples * self.mem_per_sample
+
+    def encode(self, in_x):
+        """ stores `in_x` as keyframes / deltas. Returns their (B, 2) handles """
+
+        # the current keyframe might have been collected
+        if self.coder.key is not None and not (self.bkey_uid == self.key_uid).any():
+            self.coder.reset()
+
+        uids = list(range(self.next_uid, self.next_uid + in_x.size(0)))
+        self.next_uid += in_x.size(0)
+
+        refs, keys, owner, pos, val = [], [], [], [], []
+        for uid, x, (is_key, changed, values) in zip(uids, in_x, self.coder.encode(in_x)):
+            if is_key:
+                self.key_uid = uid
+                keys  += [x.reshape(1, -1)]
+            else:
+                owner += [torch.full_like(changed, uid)]
+                pos   += [changed]
+                val   += [values]
+
+            refs += [self.key_uid]
+
+        self.bkeys    = torch.cat([self.bkeys] + keys)
+        self.bkey_uid = torch.cat((self.bkey_uid, self.bkey_uid.new_tensor(
+                            [uid for uid, ref in zip(uids, refs) if uid == ref])))
+
+        if len(pos) > 0:
+            self.bdelta_owner = torch.cat([self.bdelta_owner] + owner)
+            self.bdelta_pos   = torch.cat([self.bdelta_pos] + pos)
+            self.bdelta_val   = torch.cat([self.bdelta_val] + val)
+
+        return torch.LongTensor([refs, uids]).t().to(in_x.device)
+
+    def decode(self, handles):
+        """ rebuilds the code maps of (n, 2) handles """
+
+        # uids are increasing, and kept in order
+        x = self.bkeys[torch.searchsorted(self.bkey_uid, handles[:, 0].contiguous())]
+
+        sel = torch.isin(self.bdelta_owner, handles[:, 1])
+        if sel.any():
+            uids, order = handles[:, 1].sort()
+            rows = order[torch.searchsorted(uids, self.bdelta_owner[sel])]
+            x[rows, self.bdelta_pos[sel]] = self.bdelta_val[sel]
+
+        return x.view(handles.size(0), *self.input_size)
+
+    def collect(self):
+        """ drops the deltas and keyframes no sample refers to anymore """
+
+        alive = torch.isin(self.bdelta_owner, self.bx[:, 1])
+        self.bdelta_owner = self.bdelta_owner[alive]
+        self.bdelta_pos   = self.bdelta_pos[alive]
+        self.bdelta_val   = self.bdelta_val[alive]
+
+        alive = torch.isin(self.bkey_uid, self.bx[:, 0])
+        self.bkeys    = self.bkeys[alive]
+        self.bkey_uid = self.bkey_uid[alive]
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        if self.keyframe_interval > 0:
+            if prefix + 'bkeys' not in state_dict:
+                # checkpoint holding full code maps : code them on load
+                bx = state_dict[prefix + 'bx']
+                add_info = {'y': state_dict[prefix + 'by'], 't': state_dict[prefix + 'bt'],
+                            'bidx': state_dict[prefix + 'bidx'], 'step': state_dict[prefix + 'bstep']}
+
+                self.expand(0)
+                self.to(bx.device)
+                self.add(bx, add_info)
+                return
+
+            # keyframe / delta storage does not scale with the amount of samples
+            for name in self.DELTA_BUFFERS:
+                setattr(self, name, torch.empty_like(state_dict[prefix + name]))
+
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+        if self.keyframe_interval > 0:
+            self.coder.reset()
+            self.next_uid = int(self.bx[:, 1].max()) + 1 if self.bx.size(0) > 0 else 0
+            self.n_memory = self.memory()
+
+    def get_x(self, idx):
+        return self.decode(self.bx[idx]) if self.keyframe_interval > 0 else self.bx[idx]
 
     @property
     def x(self):
-        return self.bx[:self.n_samples]
+        return self.get_x(slice(0, self.n_samples))
 
     @property
     def y(self):
@@ -50,6 +218,7 @@ class Buffer(nn.Module):
         return self.bt[:self.n_samples]
 
     @torch.no_grad()
+    @profiled('buffer.add')
     def add(self, in_x, add_info, idx=None):
 
         """ concatenate a sample at the end of the buffer """
@@ -77,6 +246,9 @@ class Buffer(nn.Module):
             in_idx  = in_idx[idx]
             in_step = in_step[idx]
 
+        if self.keyframe_interval > 0:
+            in_x = self.encode(in_x)
+
         if self.bx.size(0) > in_x.size(0):
             swap_idx = torch.randperm(self.bx.size(0))[:in_x.size(0)]
 
@@ -102,10 +274,11 @@ class Buffer(nn.Module):
         self.bstep  = torch.cat((self.bstep, in_step))
 
         self.n_samples += in_x.size(0)
-        self.n_memory  += in_x.size(0) * self.mem_per_sample
+        self.n_memory   = self.memory()
 
 
     @torch.no_grad()
+    @profiled('buffer.free')
     def free(self, n_samples=None, idx=None):
         """ free buffer space. Assumes data is shuffled when added"""
 
@@ -121,6 +294,8 @@ class Buffer(nn.Module):
         n_samples = int(n_samples)
         assert n_samples <= self.n_samples, pdb.set_trace()
 
+        n_memory = self.n_memory
+
         if idx is not None:
             class_removed = self.y[idx].sum(0)
 
@@ -142,18 +317,27 @@ class Buffer(nn.Module):
             self.bidx = self.bidx[:-n_samples]
             self.bstep = self.bstep[:-n_samples]
 
+        if self.keyframe_interval > 0:
+            self.collect()
+
         self.n_samples -= n_samples
-        self.n_memory  -= n_samples * self.mem_per_sample
+        self.n_memory   = self.memory()
 
-        return class_removed, n_samples * self.mem_per_sample
+        return class_removed, n_memory - self.n_memory
 
 
     def adjust_n_embeds(self, n_embeds):
+        self.max_idx = n_embeds
         self.mem_per_sample = np.prod(self.input_size) * np.log2(n_embeds) / np.log2(256.)
-        self.n_memory = self.n_samples * self.mem_per_sample
+
+        if self.keyframe_interval > 0:
+            self.coder.adjust_n_embeds(n_embeds)
+
+        self.n_memory = self.memory()
 
 
     @torch.no_grad()
+    @profiled('buffer.try_and_remove')
     def try_and_remove(self, n_samples, class_counts):
         # figure out how much per class this means
 
@@ -215,6 +399,7 @@ class Buffer(nn.Module):
 
 
     @torch.no_grad()
+    @profiled('buffer.sample')
     def sample(self, amt=None, y_samples=None):
 
         # one or the other
@@ -223,11 +408,11 @@ class Buffer(nn.Module):
             assert y_samples is not None
 
             if y_samples.sum() == 0:
-                return self.bx[:0], {'y': self.by[:0],
-                                     't': self.bt[:0],
-                                     'idx': self.bidx[:0],
-                                     'bidx': self.bidx[:0],
-                                     'step': self.bstep[:0]}
+                return self.get_x(slice(0, 0)), {'y': self.by[:0],
+                                                 't': self.bt[:0],
+                                                 'idx': self.bidx[:0],
+                                                 'bidx': self.bidx[:0],
+                                                 'step': self.bstep[:0]}
 
             # get the indices
 
@@ -259,11 +444,11 @@ class Buffer(nn.Module):
 
             indices = torch.from_numpy(np.random.choice(bx.size(0), amt, replace=False)).to(bx.device)
 
-        return self.bx[indices], {'y': self.by[indices],
-                                  't': self.bt[indices],
-                                  'idx': indices,
-                                  'bidx': self.bidx[indices],
-                                  'step': self.bstep[indices]}
+        return self.get_x(indices), {'y': self.by[indices],
+                                     't': self.bt[indices],
+                                     'idx': indices,
+                                     'bidx': self.bidx[indices],
+                                     'step': self.bstep[indices]}
 
 
     @torch.no_grad()
@@ -274,30 +459,37 @@ class Buffer(nn.Module):
 
         for batch in range(n_batches):
             idx = range(batch * BS, min(self.n_samples, (batch+1) * BS))
-            yield self.bx[idx], {'y': self.by[idx],
-                                 't': self.bt[idx],
-                                 'idx': idx,
-                                 'bidx': self.bidx[idx],
-                                 'step': self.bstep[idx]}
+            yield self.get_x(idx), {'y': self.by[idx],
+                                    't': self.bt[idx],
+                                    'idx': idx,
+                                    'bidx': self.bidx[idx],
+                                    'step': self.bstep[idx]}
 
 
 if __name__ == '__main__':
-    import numpy as np
+    """ smoke test : random adds and class-balanced removals """
 
-    for i in range(1000):
-        print(i)
+    INPUT_SIZE = (3, 32, 32)
+    N_CLASSES  = 10
 
-        B = np.random.randint(100)
-        INPUT_SIZE = (3, 32, 32)
-        N_CLASSES  = 10
+    for i in range(100):
+        B = np.random.randint(1, 100)
         buf = Buffer(INPUT_SIZE, N_CLASSES, dtype=torch.FloatTensor)
 
         in_x = torch.FloatTensor(size=(B, ) + INPUT_SIZE).normal_()
         in_y = torch.FloatTensor(B).uniform_(0, N_CLASSES).long()
-        in_t = in_idx = in_step = torch.zeros_like(in_y)
 
-        buf.add(in_x, in_y, in_t, in_idx, in_step)
+        buf.add(in_x, {'y': in_y, 't': 0, 'bidx': torch.arange(B), 'step': i})
+        assert buf.n_samples == B
 
         class_counts = torch.FloatTensor(N_CLASSES).uniform_(0, 50).long()
+        n_removed    = np.random.randint(100)
+
+        buf.try_and_remove(n_removed, class_counts)
+        assert buf.n_samples <= B and buf.bx.size(0) == buf.by.size(0) == buf.n_samples
+
+        if buf.n_samples > 0:
+            x, add_info = buf.sample(y_samples=buf.y.sum(0))
+            assert x.size(0) == buf.n_samples
 
-        buf.try_and_remove(np.random.randint(100), class_counts)
+    print('ok')
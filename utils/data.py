@@ -6,36 +6,37 @@ import numpy as np
 import pickle as pkl
 from PIL import Image
 from copy import deepcopy
+from collections import OrderedDict
 from random import shuffle
-from torchvision import datasets, transforms
 
 """ Template Dataset with Labels """
 class XYDataset(torch.utils.data.Dataset):
+    """ in-memory (or memory-mapped) uint8 images `x` and labels `y`. Datasets
+        stored as files (mini-imagenet) are first packed in shards, see
+        `load_image_shard` """
+
     def __init__(self, x, y, **kwargs):
+        assert torch.is_tensor(x), 'pack the images in a tensor (see `load_image_shard`)'
         self.x, self.y = x, y
 
-        self.rescale = lambda x : (x / 255. - 0.5) * 2.
-
         # this was to store the inverse permutation in permuted_mnist
         # so that we could 'unscramble' samples and plot them
         for name, value in kwargs.items():
             setattr(self, name, value)
 
+    def rescale(self, x):
+        return (x / 255. - 0.5) * 2.
+
     def __len__(self):
         return len(self.x)
 
     def __getitem__(self, idx):
-        x, y = self.x[idx], self.y[idx]
-
-        if type(x) != torch.Tensor:
-            # mini_imagenet
-            # we assume it's a path --> load from file
-            x = self.transform(Image.open(x).convert('RGB'))
-            y = torch.Tensor(1).fill_(y).long().squeeze()
-        else:
-            x = x.float() / 255.
-            y = y.long()
+        if isinstance(idx, (list, torch.Tensor)):
+            # a whole batch of indices (see `CLDataLoader`)
+            return self.get_batch(idx)
 
+        x = self.x[idx].float() / 255.
+        y = self.y[idx].long()
 
         # for some reason mnist does better \in [0,1] than [-1, 1]
         if self.source == 'mnist':
@@ -43,75 +44,335 @@ class XYDataset(torch.utils.data.Dataset):
         else:
             return (x - .5) * 2, y, idx
 
+    def get_batch(self, idx):
+        """ fetch (in-memory) samples with a single gather, and normalize them
+            with one vectorized op """
+
+        idx = torch.as_tensor(idx, dtype=torch.long)
+
+        x = self.x[idx].float().div_(255.)
+        y = self.y[idx].long()
+
+        if self.source == 'mnist':
+            return x, y
+        else:
+            return x.sub_(.5).mul_(2.), y, idx
+
+
+class ReplayDataset(torch.utils.data.Dataset):
+    """ the decoded content of a (frozen) AQM memory, as (x, y) samples.
+
+        By default, the whole memory is decoded once and kept in one tensor,
+        (uint8 if `as_uint8`, i.e. 4x smaller). When `lazy`, samples are
+        decoded on request, `chunk` buffer entries at a time, and the last
+        `cache_size` decoded chunks are kept. Use with `batch_size=None`
+        batch samplers (see `CLDataLoader.batch_loader`).
+
+        With `latent` > 0, samples are kept in the representation of block
+        `latent` (see `QStack.to_latent`) instead of being fully decoded """
+
+    def __init__(self, aqm, as_uint8=False, lazy=False, chunk=256, cache_size=64, device='cpu', latent=0):
+        self.aqm      = aqm
+        self.latent   = latent
+        self.as_uint8 = as_uint8 and latent == 0
+        self.lazy     = lazy
+        self.chunk    = chunk
+        self.device   = device
+
+        # samples are ordered by block, as in `QStack.sample_everything`
+        self.blocks  = [block for block in reversed(aqm.all_blocks) if block.n_samples > 0]
+        self.lens    = np.array([block.n_samples for block in self.blocks])
+        self.cumlens = np.cumsum(self.lens)
+
+        if lazy:
+            self.cache, self.cache_size = OrderedDict(), cache_size
+        else:
+            with torch.no_grad():
+                xs, ys = zip(*[(self.compress(x), add_info['y'].to(device))
+                                    for x, add_info in aqm.sample_everything(latent)])
+            self.x, self.y = torch.cat(xs), torch.cat(ys)
+
+    def compress(self, x):
+        x = x.to(self.device)
+        return ((x * .5 + .5) * 255).round_().clamp_(0, 255).byte() if self.as_uint8 else x
+
+    def uncompress(self, x):
+        return (x.float() / 255. - .5) * 2. if self.as_uint8 else x
+
+    def __len__(self):
+        return int(self.lens.sum())
+
+    @torch.no_grad()
+    def read_chunk(self, block_idx, chunk_idx):
+        key = (block_idx, chunk_idx)
+
+        if key not in self.cache:
+            block = self.blocks[block_idx]
+            idx   = range(chunk_idx * self.chunk, min(block.n_samples, (chunk_idx + 1) * self.chunk))
+
+            x = self.aqm.to_latent(block.fetch(idx), block.id, self.latent)
+            self.cache[key] = (self.compress(x), block.buffer.by[idx].to(self.device))
+
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+        self.cache.move_to_end(key)
+        return self.cache[key]
+
+    def get_batch(self, idx):
+        idx = np.asarray(idx)
+
+        if not self.lazy:
+            idx = torch.from_numpy(idx)
+            return self.uncompress(self.x[idx]), self.y[idx]
+
+        block_idx = np.searchsorted(self.cumlens, idx, side='right')
+        pos = idx - (self.cumlens - self.lens)[block_idx]
+
+        x = y = None
+        for b, c in set(zip(block_idx.tolist(), (pos // self.chunk).tolist())):
+            sel = np.nonzero((block_idx == b) & (pos // self.chunk == c))[0]
+            x_c, y_c = self.read_chunk(b, c)
+
+            if x is None:
+                x = x_c.new_empty((idx.shape[0],) + x_c.shape[1:])
+                y = y_c.new_empty(idx.shape[0])
+
+            in_chunk = torch.from_numpy(pos[sel] % self.chunk).to(x_c.device)
+            sel      = torch.from_numpy(sel).to(x_c.device)
+            x[sel], y[sel] = x_c[in_chunk], y_c[in_chunk]
+
+        return self.uncompress(x), y
+
+    def __getitem__(self, idx):
+        return self.get_batch(idx)
+
 
 class Kitti_dataset(torch.utils.data.Dataset):
-    def __init__(self, paths, hist_equalize=True):
+    def __init__(self, paths, hist_equalize=True, batch_equalize=False):
         self.paths = paths
-        self.datas = [np.load(path) for path in paths]
-        self.lens  = [len(x) for x in self.datas]
+
+        # every recording is read from a flat, memory-mapped (N, C, H, W) array
+        self.cache_paths = [kitti_cache(path) for path in paths]
+        self.lens  = [np.load(path, mmap_mode='r').shape[0] for path in self.cache_paths]
         self.cumlens = np.cumsum(self.lens)
 
+        # memory maps are opened lazily, once per (worker) process
+        self.datas = None
+
         self.len = sum(self.lens)
 
+        # when `batch_equalize`, items are returned raw and the histogram
+        # equalization is applied on whole (on-device) batches via `equalize`
         self.eq = hist_equalize
+        self.batch_eq = batch_equalize
         self.hist = KITTI_HIST
         self.bins = BINS
         self.cdf = self.hist.cumsum()
         self.cdf = 255 * self.cdf / self.cdf[-1]
 
-    def unnorm(self, x):
-
-        dev = None
-        if type(x) == torch.Tensor:
-            dev = x.device
-            x = x.cpu().data.numpy()
+        self.interp_norm   = Interp(self.bins[:-1], self.cdf)
+        self.interp_unnorm = Interp(self.cdf, self.bins[:-1])
 
-        x = np.interp(x.flatten(), self.cdf, self.bins[:-1]).reshape(x.shape)
+    def open(self):
+        self.datas = [np.load(path, mmap_mode='r') for path in self.cache_paths]
 
-        if dev is not None:
-            x = torch.from_numpy(x).to(dev).float()
+    def __getstate__(self):
+        # never ship open file handles to DataLoader workers
+        state = self.__dict__.copy()
+        state['datas'] = None
+        return state
 
-        return x * .5 + .5
+    def unnorm(self, x):
+        return self.interp_unnorm(x) * .5 + .5
 
     def norm(self, x):
-        x = np.interp(x.flatten(), self.bins[:-1], self.cdf).reshape(x.shape).astype(np.float32)
-        return (x - .5) * 2.
+        return (self.interp_norm(x) - .5) * 2.
 
+    def equalize(self, x):
+        """ histogram equalization of a batch, if it was deferred out of `__getitem__` """
+        return self.norm(x) if (self.eq and self.batch_eq) else x
 
     def __len__(self):
         return self.len
 
+    def locate(self, idx):
+        """ map a global index to (recording, index within recording) """
+        rec_idx = np.searchsorted(self.cumlens, idx, side='right')
+        sample_idx = idx - (self.cumlens - self.lens)[rec_idx]
+
+        return rec_idx, sample_idx
+
     def __getitem__(self, idx):
-        rec_idx = np.argwhere((idx < self.cumlens) == 1).min()
-        sample_idx = idx - (self.cumlens[rec_idx - 1] if rec_idx > 0 else 0)
+        if self.datas is None:
+            self.open()
 
-        item = self.datas[rec_idx]['%d.npy' % sample_idx]
+        rec_idx, sample_idx = self.locate(idx)
 
-        if self.eq:
+        # zero-copy view into the memory map
+        item = self.datas[rec_idx][sample_idx]
+
+        if self.eq and not self.batch_eq:
             item = self.norm(item)
+        else:
+            item = np.array(item)
 
         # TODO: should we map back and forth from polar to xyz ?
         return item,  0, idx
 
+    def get_batch(self, idx):
+        """ fetch samples with one indexed read per recording. The histogram
+            equalization (if any) is always applied """
+        if self.datas is None:
+            self.open()
+
+        idx = np.asarray(idx)
+        rec_idx, sample_idx = self.locate(idx)
+
+        x = np.empty((idx.shape[0],) + self.datas[0].shape[1:], dtype=self.datas[0].dtype)
+        for rec in np.unique(rec_idx):
+            x[rec_idx == rec] = self.datas[rec][sample_idx[rec_idx == rec]]
+
+        x = torch.from_numpy(x)
+        if self.eq: x = self.norm(x)
+
+        return x, torch.zeros(idx.shape[0]).long(), torch.from_numpy(idx)
+
+
+class Interp(object):
+    """ torch-native, batched equivalent of `np.interp(x, xp, fp)` for fixed
+        sample points. Numpy inputs are mapped to numpy outputs, tensors stay
+        on their device """
+
+    def __init__(self, xp, fp):
+        xp, fp = np.asarray(xp, dtype=np.float64), np.asarray(fp, dtype=np.float64)
+
+        # one linear piece `intercept + slope * x` per segment, plus two constant
+        # pieces for the extrapolation on both sides. Empty segments (repeated
+        # `xp`) are never selected by the right-sided search.
+        dx = np.diff(xp)
+        slope = np.divide(np.diff(fp), dx, out=np.zeros_like(dx), where=dx > 0)
+        intercept = fp[:-1] - slope * xp[:-1]
+
+        self.slope     = np.concatenate(([0.], slope, [0.]))
+        self.intercept = np.concatenate(([fp[0]], intercept, [fp[-1]]))
+        self.xp = xp
+
+        # uniformly spaced sample points (e.g. histogram bins) need no search
+        self.uniform = np.allclose(dx, dx[0], rtol=1e-4)
+        self.x0, self.dx = xp[0], dx[0]
+
+        self.tables = {}
+
+    def get_tables(self, device, dtype):
+        key = (str(device), dtype)
+        if key not in self.tables:
+            self.tables[key] = [torch.from_numpy(t).to(device=device, dtype=dtype)
+                                    for t in (self.xp, self.slope, self.intercept)]
+        return self.tables[key]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['tables'] = {}
+        return state
+
+    def __call__(self, x):
+        is_np = not isinstance(x, torch.Tensor)
+        if is_np:
+            x = torch.from_numpy(np.asarray(x, dtype=np.float32))
+
+        xp, slope, intercept = self.get_tables(x.device, x.dtype)
+        x_flat = x.reshape(-1)
+
+        # index of the linear piece x falls in
+        if self.uniform:
+            j = ((x_flat - self.x0) / self.dx).floor_().add_(1).clamp_(0, xp.size(0)).long()
+        else:
+            j = torch.searchsorted(xp, x_flat, right=True)
+
+        out = torch.addcmul(intercept[j], slope[j], x_flat).view_as(x)
+
+        return out.numpy() if is_np else out
+
+
+def kitti_cache(path):
+    """ one-time conversion of a `processed.npz` recording into a flat `.npy`
+        array which can be memory-mapped. Returns the path of the array """
+
+    out_path = os.path.splitext(path)[0] + '.npy'
+
+    if os.path.exists(out_path) and os.path.getmtime(out_path) >= os.path.getmtime(path):
+        return out_path
+
+    print('building kitti cache for %s' % path)
+    npz = np.load(path)
+    n_frames = len(npz.files)
+    first = npz['0.npy']
+
+    # write to a temporary file first, so that an interrupted conversion
+    # never leaves a truncated cache behind
+    tmp_path = out_path + '.tmp'
+    out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=first.dtype,
+                                    shape=(n_frames,) + first.shape)
+    for i in range(n_frames):
+        out[i] = npz['%d.npy' % i]
+
+    out.flush()
+    del out
+    npz.close()
+    os.replace(tmp_path, out_path)
+
+    return out_path
+
+
+def worker_init(worker_id):
+    """ give every DataLoader worker its own storage handles """
+    dataset = torch.utils.data.get_worker_info().dataset
+    if hasattr(dataset, 'open'):
+        dataset.open()
+
 
 """ Template Dataset for Continual Learning """
 class CLDataLoader(object):
-    def __init__(self, datasets_per_task, args, train=True):
-        test_bs, num_workers = 128, 8
+    def __init__(self, datasets_per_task, args, train=True, shuffle=True):
+        test_bs = 128
+        num_workers = 8 if args.num_workers is None else args.num_workers
 
         if 'kitti' in args.dataset:
             test_bs = 32
-            num_workers = 0
         elif 'imagenet' in args.dataset:
             test_bs = 32
 
         bs = args.batch_size if train else test_bs
         if args.debug: num_workers = 0
 
+        worker_kwargs = {}
+        if num_workers > 0:
+            # optionally keep workers (and their prefetched batches) alive across epochs
+            worker_kwargs = {'worker_init_fn': worker_init,
+                             'persistent_workers': bool(args.persistent_workers),
+                             'prefetch_factor': args.prefetch_factor or 2}
+
         self.datasets = datasets_per_task
         self.loaders = [
-                torch.utils.data.DataLoader(x, batch_size=bs, shuffle=True, drop_last=train,
-                    num_workers=num_workers) for x in self.datasets ]
+                self.batch_loader(x, bs, shuffle, drop_last=train) if self.in_memory(x) else
+                torch.utils.data.DataLoader(x, batch_size=bs, shuffle=shuffle, drop_last=train,
+                    num_workers=num_workers, **worker_kwargs) for x in self.datasets ]
+
+    @staticmethod
+    def in_memory(dataset):
+        return isinstance(getattr(dataset, 'x', None), torch.Tensor) and hasattr(dataset, 'get_batch')
+
+    @staticmethod
+    def batch_loader(dataset, bs, shuffle, drop_last):
+        """ the sampler yields whole index batches, which the dataset slices at once.
+            This skips per-sample `__getitem__` calls and collation """
+
+        sampler = torch.utils.data.RandomSampler(dataset) if shuffle else \
+                  torch.utils.data.SequentialSampler(dataset)
+        sampler = torch.utils.data.BatchSampler(sampler, bs, drop_last)
+
+        return torch.utils.data.DataLoader(dataset, sampler=sampler, batch_size=None)
 
     def __getitem__(self, idx):
         return self.loaders[idx]
@@ -148,8 +409,8 @@ def get_processed_kitti(args, mode='offline'):
         train_recs = all_recs
         valid_recs = all_recs
 
-    train_ds = Kitti_dataset(train_recs)
-    valid_ds = Kitti_dataset(valid_recs)
+    train_ds = Kitti_dataset(train_recs, batch_equalize=True)
+    valid_ds = Kitti_dataset(valid_recs, batch_equalize=True)
 
     return [train_ds], [valid_ds], [valid_ds]
 
@@ -171,46 +432,31 @@ def get_split_cifar10(args):
     args.n_tasks = args.n_classes // args.n_classes_per_task
 
     # fetch data
+    from torchvision import datasets
     train = datasets.CIFAR10('../cl-pytorch/data/', train=True,  download=True)
     test  = datasets.CIFAR10('../cl-pytorch/data/', train=False, download=True)
 
-    train_x, train_y = train.data, train.targets
-    test_x,  test_y  = test.data,  test.targets
-
-    # sort according to the label
-    out_train = [
-        (x,y) for (x,y) in sorted(zip(train_x, train_y), key=lambda v : v[1]) ]
-
-    out_test = [
-        (x,y) for (x,y) in sorted(zip(test_x, test_y), key=lambda v : v[1]) ]
-
-    train_x, train_y = [
-            np.stack([elem[i] for elem in out_train]) for i in [0,1] ]
-
-    test_x,  test_y  = [
-            np.stack([elem[i] for elem in out_test]) for i in [0,1] ]
-
-    train_x = torch.Tensor(train_x).permute(0, 3, 1, 2).contiguous()
-    test_x  = torch.Tensor(test_x).permute(0, 3, 1, 2).contiguous()
+    train_x, train_y = train.data, np.asarray(train.targets)
+    test_x,  test_y  = test.data,  np.asarray(test.targets)
 
-    train_y = torch.Tensor(train_y)
-    test_y  = torch.Tensor(test_y)
+    def make_splits():
+        # group the samples of `n_classes_per_task` consecutive classes
+        skip = args.n_classes_per_task
+        out = {}
+        for split, y in [('train', train_y), ('test', test_y)]:
+            order, bounds = class_sorted_indices(y, 10)
+            out[split] = [order[bounds[i]:bounds[i + skip]] for i in range(0, 10, skip)]
 
-    # get indices of class split
-    train_idx = [((train_y + i) % 10).argmax() for i in range(10)]
-    train_idx = [0] + [x + 1 for x in sorted(train_idx)]
+        return out
 
-    test_idx  = [((test_y + i) % 10).argmax() for i in range(10)]
-    test_idx  = [0] + [x + 1 for x in sorted(test_idx)]
+    splits = cached_splits(args, 'split_cifar10_%dcpt' % args.n_classes_per_task, make_splits)
 
-    train_ds, valid_ds, test_ds = [], [], []
-    skip = args.n_classes_per_task
-    for i in range(0, 10, skip):
-        tr_s, tr_e = train_idx[i], train_idx[i + skip]
-        te_s, te_e = test_idx[i],  test_idx[i + skip]
+    # images are kept as uint8, and converted to float one batch at a time
+    to_ds = lambda x, y, idx : (torch.from_numpy(x[idx.numpy()]).permute(0, 3, 1, 2).contiguous(),
+                                torch.from_numpy(y[idx.numpy()]).long())
 
-        train_ds += [(train_x[tr_s:tr_e], train_y[tr_s:tr_e])]
-        test_ds  += [(test_x[te_s:te_e],  test_y[te_s:te_e])]
+    train_ds = [to_ds(train_x, train_y, idx) for idx in splits['train']]
+    test_ds  = [to_ds(test_x,  test_y,  idx) for idx in splits['test']]
 
     train_ds, valid_ds = make_valid_from_train(train_ds)
 
@@ -238,83 +484,50 @@ def get_split_cifar100(args):
         args.n_classes_per_task = 5
 
     # fetch data
+    from torchvision import datasets
     train = datasets.CIFAR100('../../cl-pytorch/data/', train=True,  download=True)
     test  = datasets.CIFAR100('../../cl-pytorch/data/', train=False, download=True)
 
-    train_x, train_y = train.data, train.targets
-    test_x,  test_y  = test.data,  test.targets
-
-    # sort according to the label
-    out_train = [
-        (x,y) for (x,y) in sorted(zip(train_x, train_y), key=lambda v : v[1]) ]
-
-    out_test = [
-        (x,y) for (x,y) in sorted(zip(test_x, test_y), key=lambda v : v[1]) ]
-
-    train_x, train_y = [
-            np.stack([elem[i] for elem in out_train]) for i in [0,1] ]
+    train_x, train_y = train.data, np.asarray(train.targets)
+    test_x,  test_y  = test.data,  np.asarray(test.targets)
 
-    test_x,  test_y  = [
-            np.stack([elem[i] for elem in out_test]) for i in [0,1] ]
+    def make_splits():
+        train_order, train_bounds = class_sorted_indices(train_y, 100)
+        test_order,  test_bounds  = class_sorted_indices(test_y,  100)
 
-    train_x = torch.Tensor(train_x).permute(0, 3, 1, 2).contiguous()
-    test_x  = torch.Tensor(test_x).permute(0, 3, 1, 2).contiguous()
+        # get all classes individually first
+        train_classes, valid_classes, test_classes = [], [], []
+        for i in range(100):
+            tr_s, tr_e = train_bounds[i], train_bounds[i + 1]
+            te_s, te_e = test_bounds[i],  test_bounds[i + 1]
 
-    train_y = torch.Tensor(train_y)
-    test_y  = torch.Tensor(test_y)
+            split = tr_s + int(0.9 * (tr_e - tr_s))
 
-    # get indices of class split
-    train_idx = [((train_y + i) % 100).argmax() for i in range(100)]
-    train_idx = [0] + [x + 1 for x in sorted(train_idx)]
+            train_classes += [train_order[tr_s:split]]
+            valid_classes += [train_order[split:tr_e]]
+            test_classes  += [test_order[te_s:te_e]]
 
-    test_idx  = [((test_y + i) % 100).argmax() for i in range(100)]
-    test_idx  = [0] + [x + 1 for x in sorted(test_idx)]
+        # note: previously we shuffled the classes to make the split
+        # random. However we left it out to be consistent with A-GEM
 
-    train_ds, valid_ds, test_ds = [], [], []
-    skip = 1 # get all classes individually first
-    for i in range(0, 100):
-        tr_s, tr_e = train_idx[i], train_idx[i + skip]
-        te_s, te_e = test_idx[i],  test_idx[i + skip]
-
-        train_size = tr_e - tr_s
-        split = tr_s + int(0.9 * train_size.item())
+        skip = args.n_classes_per_task
+        group = lambda classes : [torch.cat(classes[i:i + skip]) for i in range(0, 100, skip)]
 
-        train_ds += [(train_x[tr_s:split], train_y[tr_s:split])]
-        valid_ds += [(train_x[split:tr_e], train_y[split:tr_e])]
-        test_ds  += [(test_x[te_s:te_e],  test_y[te_s:te_e])]
+        # TODO: remove this
+        # Facebook actually does 17 tasks (3 to CV)
+        return {'train': group(train_classes)[:args.n_tasks],
+                'valid': group(valid_classes)[:args.n_tasks],
+                'test':  group(test_classes)[:args.n_tasks]}
 
-    # next we randomly partition the dataset
-    indices = [x for x in range(100)]
+    splits = cached_splits(args, 'split_cifar100_%dcpt_%dt' % (args.n_classes_per_task, args.n_tasks), make_splits)
 
-    # note: previously we shuffled the indices to make the split
-    # random. However we left it out to be consistent with A-GEM
+    # images are kept as uint8, and converted to float one batch at a time
+    to_ds = lambda x, y, idx : (torch.from_numpy(x[idx.numpy()]).permute(0, 3, 1, 2).contiguous(),
+                                torch.from_numpy(y[idx.numpy()]).long())
 
-    train_classes = [train_ds[indices[i]] for i in range(100)]
-    valid_classes = [valid_ds[indices[i]] for i in range(100)]
-    test_classes  = [test_ds[indices[i]]  for i in range(100)]
-
-    train_ds, valid_ds, test_ds = [], [], []
-
-    skip = args.n_classes_per_task
-    for i in range(0, 100, skip):
-        train_task_ds, valid_task_ds, test_task_ds = [[], []], [[], []], [[], []]
-        for j in range(skip):
-            train_task_ds[0] += [train_classes[i + j][0]]
-            train_task_ds[1] += [train_classes[i + j][1]]
-            valid_task_ds[0] += [valid_classes[i + j][0]]
-            valid_task_ds[1] += [valid_classes[i + j][1]]
-            test_task_ds[0]  += [test_classes[i + j][0]]
-            test_task_ds[1]  += [test_classes[i + j][1]]
-
-        train_ds += [(torch.cat(train_task_ds[0]), torch.cat(train_task_ds[1]))]
-        valid_ds += [(torch.cat(valid_task_ds[0]), torch.cat(valid_task_ds[1]))]
-        test_ds  += [(torch.cat(test_task_ds[0]), torch.cat(test_task_ds[1]))]
-
-    # TODO: remove this
-    # Facebook actually does 17 tasks (3 to CV)
-    train_ds = train_ds[:args.n_tasks]
-    valid_ds = valid_ds[:args.n_tasks]
-    test_ds  = test_ds[:args.n_tasks]
+    train_ds = [to_ds(train_x, train_y, idx) for idx in splits['train']]
+    valid_ds = [to_ds(train_x, train_y, idx) for idx in splits['valid']]
+    test_ds  = [to_ds(test_x,  test_y,  idx) for idx in splits['test']]
 
     # build masks
     masks = []
@@ -384,6 +597,7 @@ def get_miniimagenet(args):
         return data, label
 
 
+    from torchvision import transforms
     transform = transforms.Compose([
         transforms.Resize(size),
         transforms.CenterCrop(size),
@@ -456,13 +670,93 @@ def get_miniimagenet(args):
 
     task_ids = torch.from_numpy(np.stack(task_ids)).to(args.device).long()
 
-    train_ds  = map(lambda x, y : XYDataset(x[0], x[1], **{'source':'cifar100', 'mask':y, 'task_ids':task_ids, 'transform':transform}), train_ds, masks)
-    valid_ds  = map(lambda x, y : XYDataset(x[0], x[1], **{'source':'cifar100', 'mask':y, 'task_ids':task_ids, 'transform':transform}), valid_ds, masks)
-    test_ds   = map(lambda x, y : XYDataset(x[0], x[1], **{'source':'cifar100', 'mask':y, 'task_ids':task_ids, 'transform':transform}), test_ds, masks)
+    # decode and resize every image once. Afterwards, samples are read from
+    # memory-mapped uint8 shards (one per split / task) keyed by `data_size`
+    shard_dir = os.path.join(get_cache_dir(args), 'miniimagenet_%s' % 'x'.join(map(str, args.data_size)))
+    load = lambda split, task, ds : \
+            load_image_shard(shard_dir, '%s_%dcpt_%d' % (split, args.n_classes_per_task, task), ds[0], ds[1], transform)
+
+    train_ds = [load('train', task, ds) for task, ds in enumerate(train_ds)]
+    valid_ds = [load('valid', task, ds) for task, ds in enumerate(valid_ds)]
+    test_ds  = [load('test',  task, ds) for task, ds in enumerate(test_ds)]
+
+    train_ds  = map(lambda x, y : XYDataset(x[0], x[1], **{'source':'cifar100', 'mask':y, 'task_ids':task_ids}), train_ds, masks)
+    valid_ds  = map(lambda x, y : XYDataset(x[0], x[1], **{'source':'cifar100', 'mask':y, 'task_ids':task_ids}), valid_ds, masks)
+    test_ds   = map(lambda x, y : XYDataset(x[0], x[1], **{'source':'cifar100', 'mask':y, 'task_ids':task_ids}), test_ds, masks)
 
     return train_ds, valid_ds, test_ds
 
 
+def class_sorted_indices(y, n_classes):
+    """ stable sort of the samples w.r.t. their label. Returns the sorted
+        indices and the class boundaries (class `c` is in bounds[c]:bounds[c+1]) """
+
+    order  = torch.from_numpy(np.argsort(y, kind='stable'))
+    bounds = np.concatenate(([0], np.cumsum(np.bincount(y, minlength=n_classes))))
+
+    return order, bounds
+
+
+def cached_splits(args, name, make_splits):
+    """ per-task sample indices, computed once and stored in the cache folder """
+
+    path = os.path.join(get_cache_dir(args), name + '.pt')
+    if os.path.exists(path):
+        return torch.load(path)
+
+    splits = make_splits()
+    torch.save(splits, path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+    return splits
+
+
+def get_cache_dir(args):
+    """ folder holding preprocessed versions of the datasets """
+    cache_dir = args.cache_dir or os.path.join(args.data_folder or '.', 'cache')
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+
+def load_image_shard(shard_dir, name, paths, labels, transform):
+    """ returns the images in `paths` as a (N, C, H, W) uint8 tensor backed by a
+        memory-mapped shard, which is built (once) if it does not exist """
+
+    x_path = os.path.join(shard_dir, name + '_x.npy')
+    y_path = os.path.join(shard_dir, name + '_y.npy')
+
+    if not (os.path.exists(x_path) and os.path.exists(y_path)):
+        from concurrent.futures import ThreadPoolExecutor
+        from torchvision import transforms
+
+        print('building image shard %s' % x_path)
+        os.makedirs(shard_dir, exist_ok=True)
+
+        # `transform` ends with `ToTensor`, which we skip to keep uint8 values
+        resize = transforms.Compose(transform.transforms[:-1])
+        prepro = lambda path : np.asarray(resize(Image.open(path).convert('RGB'))).transpose(2, 0, 1)
+
+        first = prepro(paths[0])
+        tmp_path = x_path + '.tmp'
+        out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8,
+                                        shape=(len(paths),) + first.shape)
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            for i, img in enumerate(pool.map(prepro, paths)):
+                out[i] = img
+
+        out.flush()
+        del out
+        np.save(y_path, np.asarray(labels, dtype=np.int64))
+        os.replace(tmp_path, x_path)
+
+    # copy-on-write mapping, so that torch gets a writeable array
+    x = torch.from_numpy(np.load(x_path, mmap_mode='c'))
+    y = torch.from_numpy(np.load(y_path))
+
+    return x, y
+
+
 def make_valid_from_train(dataset, cut=0.9):
     tr_ds, val_ds = [], []
     for task_ds in dataset:
@@ -0,0 +1,140 @@
+import os
+import json
+import time
+import queue
+import atexit
+import threading
+import numpy as np
+import torch
+
+""" Logging backends, all with the interface used throughout the repo :
+
+        logger.log({key: value})
+        logger.Image(data, caption=None)    # image to pass in `log`
+        logger.finish()
+
+    `LocalLogger` (default) appends the metrics to a JSONL file and saves the
+    images as png files. `WandbLogger` forwards to wandb, imported only when
+    used. `NullLogger` drops everything.
+"""
+
+
+class LocalImage(object):
+    """ (C, H, W) or (H, W) image, with values in [0, 1] """
+
+    def __init__(self, data, caption=None):
+        self.data    = data.detach() if isinstance(data, torch.Tensor) else data
+        self.caption = caption
+
+
+class LocalLogger(object):
+    """ every `log` call is a line of `<log_dir>/<project>/<run>/metrics.jsonl`,
+        with images saved under `images/`. The conversions and all the I/O run
+        in a background thread : `log` only enqueues """
+
+    Image = LocalImage
+
+    def __init__(self, log_dir, project, name, config=None):
+        run = '%s_%s' % (name, time.strftime('%Y%m%d-%H%M%S'))
+        self.run_dir = os.path.join(log_dir, project, run)
+        os.makedirs(os.path.join(self.run_dir, 'images'), exist_ok=True)
+
+        with open(os.path.join(self.run_dir, 'config.json'), 'w') as f:
+            json.dump(config, f, indent=2, default=lambda x : vars(x) if hasattr(x, '__dict__') else str(x))
+
+        self.step  = 0
+        self.queue = queue.Queue()
+
+        self.thread = threading.Thread(target=self.write, daemon=True)
+        self.thread.start()
+
+        atexit.register(self.finish)
+
+    def log(self, values):
+        self.queue.put((self.step, time.time(), values))
+        self.step += 1
+
+    def write(self):
+        with open(os.path.join(self.run_dir, 'metrics.jsonl'), 'a') as f:
+            while True:
+                item = self.queue.get()
+                if item is None: break
+
+                step, t, values = item
+                record = {'_step': step, '_time': t}
+                for key, value in values.items():
+                    record[key] = self.to_json(key, value, step)
+
+                f.write(json.dumps(record, default=str) + '\n')
+
+                if self.queue.empty(): f.flush()
+
+    def to_json(self, key, value, step):
+        if isinstance(value, (list, tuple)):
+            return [self.to_json('%s_%d' % (key, i), x, step) for i, x in enumerate(value)]
+
+        if isinstance(value, LocalImage):
+            return self.save_image(key, value, step)
+
+        if isinstance(value, torch.Tensor):
+            value = value.detach().cpu()
+            return value.item() if value.numel() == 1 else value.tolist()
+
+        if isinstance(value, (np.ndarray, np.generic)):
+            return value.tolist()
+
+        return value
+
+    def save_image(self, key, image, step):
+        from torchvision.utils import save_image
+
+        path = os.path.join('images', '%s_%d.png' % (key.replace('/', '_'), step))
+        save_image(torch.as_tensor(image.data).float().cpu(), os.path.join(self.run_dir, path))
+
+        return {'_type': 'image', 'path': path, 'caption': image.caption}
+
+    def finish(self):
+        """ waits for everything logged so far to be written """
+
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+
+class WandbLogger(object):
+    """ forwards to wandb """
+
+    def __init__(self, project, name, config=None):
+        import wandb
+
+        self.Image = wandb.Image
+        self.run   = wandb.init(project=project, name=name, config=config, reinit=True)
+
+    def log(self, values):
+        self.run.log(values)
+
+    def finish(self):
+        self.run.finish()
+
+
+class NullLogger(object):
+
+    Image = LocalImage
+
+    def log(self, values):
+        pass
+
+    def finish(self):
+        pass
+
+
+def get_logger(args, project, name, config=None):
+    """ the backend selected by `--logger` """
+
+    if args.logger == 'wandb':
+        return WandbLogger(project, name, config)
+
+    if args.logger == 'none':
+        return NullLogger()
+
+    return LocalLogger(args.log_dir or 'logs', project, name, config)
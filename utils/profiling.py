@@ -0,0 +1,235 @@
+import os
+import time
+import resource
+import threading
+import functools
+from contextlib import nullcontext, contextmanager
+
+import torch
+
+from utils.utils import RALog
+
+""" Per-stage instrumentation of the stream step.
+
+        with profiler.stage('optimize'): ...     # or the `@profiled('optimize')` decorator
+        profiler.step(logger)                    # once per stream step
+
+    Stages nest (per thread) : a stage entered inside another one is reported
+    as `outer/inner`. Work handed to other threads keeps the path of the stage
+    it was submitted from with `profiler.inherit(profiler.path())`. Every `every` steps, the average time (in ms) of every
+    stage, the current and peak RSS and, on CUDA, the peak allocated memory are
+    sent to `logger` (through a `RALog`). Optionally, a `torch.profiler` trace
+    is captured over a window of steps.
+
+    Disabled (the default), `stage` returns a shared no-op context manager.
+"""
+
+NULL = nullcontext()
+
+
+class Stage(object):
+    __slots__ = ('profiler', 'name', 'start', 'record')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name     = name
+        self.record   = None
+
+    def __enter__(self):
+        prof = self.profiler
+        prof.stack.append(self.name)
+
+        if prof.trace is not None:
+            self.record = torch.autograd.profiler.record_function(self.name)
+            self.record.__enter__()
+
+        if prof.sync: prof.synchronize()
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        prof = self.profiler
+
+        if prof.sync: prof.synchronize()
+        elapsed = time.perf_counter() - self.start
+
+        stack = prof.stack
+        with prof.lock:
+            prof.logger.log('time/' + '/'.join(stack), 1000 * elapsed)
+        stack.pop()
+
+        if self.record is not None:
+            self.record.__exit__(*exc)
+
+
+class Profiler(object):
+
+    def __init__(self):
+        self.configure()
+
+    def configure(self, every=0, sync=False, trace_steps=None, trace_dir='profile', device='cpu'):
+        """ every       : emit the breakdown every `every` steps. 0 disables everything
+            sync        : synchronize CUDA around every stage, for exact stage times
+            trace_steps : (start, n_steps) window captured with `torch.profiler`
+            trace_dir   : where the chrome traces are saved """
+
+        self.enabled  = every > 0
+        self.every    = every
+        self.sync     = sync and 'cuda' in str(device) and torch.cuda.is_available()
+        self.is_cuda  = 'cuda' in str(device) and torch.cuda.is_available()
+        self.logger   = RALog()
+        self.lock     = threading.Lock()   # stages of worker threads share `logger`
+        self.local    = threading.local()
+        self.n_steps  = 0
+        self.trace    = None
+        self.trace_steps = trace_steps
+        self.trace_dir   = trace_dir
+
+        if self.enabled and trace_steps is not None:
+            self.start_trace()
+
+        return self
+
+    def start_trace(self):
+        from torch.profiler import profile, schedule, ProfilerActivity
+
+        start, n_steps = self.trace_steps
+        os.makedirs(self.trace_dir, exist_ok=True)
+
+        activities = [ProfilerActivity.CPU]
+        if self.is_cuda: activities += [ProfilerActivity.CUDA]
+
+        def save(trace):
+            path = os.path.join(self.trace_dir, 'trace_%d.json' % self.n_steps)
+            trace.export_chrome_trace(path)
+            print('saved profiler trace to %s' % path)
+
+        self.trace = profile(activities=activities,
+                             schedule=schedule(wait=max(0, start - 1), warmup=min(1, start),
+                                               active=n_steps, repeat=1),
+                             on_trace_ready=save,
+                             profile_memory=True,
+                             record_shapes=True)
+        self.trace.__enter__()
+
+    @property
+    def stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+
+        return self.local.stack
+
+    @stack.setter
+    def stack(self, value):
+        self.local.stack = value
+
+    def path(self):
+        """ the stages the current thread is in """
+        return list(self.stack) if self.enabled else None
+
+    @contextmanager
+    def inherited(self, path):
+        stack, self.stack = self.stack, list(path)
+        try:
+            yield
+        finally:
+            self.stack = stack
+
+    def inherit(self, path):
+        """ runs the enclosed code (e.g. on a worker thread) inside the stages `path` """
+
+        if not self.enabled or path is None:
+            return NULL
+
+        return self.inherited(path)
+
+    def synchronize(self):
+        torch.cuda.synchronize()
+
+    def stage(self, name, *fmt):
+        """ times the enclosed code. `name % fmt` is only built when enabled """
+
+        if not self.enabled:
+            return NULL
+
+        return Stage(self, name % fmt if fmt else name)
+
+    def memory(self):
+        """ current and peak resident set size (in MB) and peak CUDA memory """
+
+        out = {'mem/peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.}
+
+        try:
+            with open('/proc/self/statm') as f:
+                out['mem/rss'] = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+        except (OSError, ValueError):
+            pass
+
+        if self.is_cuda:
+            out['mem/peak_cuda'] = torch.cuda.max_memory_allocated() / 2 ** 20
+
+        return out
+
+    def step(self, logger=None):
+        """ marks the end of a stream step """
+
+        if not self.enabled:
+            return
+
+        self.n_steps += 1
+
+        if self.trace is not None:
+            self.trace.step()
+            if self.n_steps >= sum(self.trace_steps):
+                self.close()
+
+        if self.n_steps % self.every == 0:
+            with self.lock:
+                for key, value in self.memory().items():
+                    self.logger.log(key, value)
+
+                values = self.logger.avg_dict(prefix='prof/')
+                self.logger.reset()
+
+            if logger is not None:
+                logger.log(values)
+
+    def summary(self):
+        """ running per-stage averages, as printable lines """
+
+        with self.lock:
+            values = self.logger.avg_dict()
+
+        return ['{:<50} {:>10.2f}'.format(key, value) for key, value in values.items()]
+
+    def close(self):
+        if self.trace is not None:
+            trace, self.trace = self.trace, None
+            trace.__exit__(None, None, None)
+
+
+profiler = Profiler()
+
+
+def profiled(name):
+    """ decorator : runs the method inside `profiler.stage(name)` """
+
+    def wrap(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not profiler.enabled:
+                return fn(*args, **kwargs)
+
+            with profiler.stage(name):
+                return fn(*args, **kwargs)
+
+        return wrapper
+    return wrap
+
+
+def configure_profiler(args):
+    """ sets up the profiler from the `--profile*` arguments """
+
+    return profiler.configure(every=args.profile, sync=args.profile_sync,
+                              trace_steps=args.profile_trace,
+                              trace_dir=os.path.join(args.log_dir or 'logs', 'profile'),
+                              device=args.device)
@@ -0,0 +1,174 @@
+import io
+import os
+import time
+import queue
+import socket
+import struct
+import threading
+import torch
+
+""" Streaming ingestion for true online learning.
+
+    A `source` yields records, i.e. dicts with keys
+        x : (B, C, H, W) tensor, uint8 (will be rescaled to [-1, 1]) or float
+        y : (B, ) long tensor
+        t : int, task id of the whole record
+    which `StreamDataset` rebatches into (x, y, task, step) batches, where
+    `step` holds the position of every sample in the stream.
+"""
+
+
+# Sources
+# ---------------------------------------------------------------------------------
+
+def write_record(folder, name, record):
+    """ used by producers. Writes a record atomically in a watched folder """
+    tmp_path = os.path.join(folder, '.' + name + '.tmp')
+    torch.save(record, tmp_path)
+    os.replace(tmp_path, os.path.join(folder, name + '.pt'))
+
+
+def send_record(sock, record):
+    """ used by producers. Sends a length-prefixed record over a socket """
+    buffer = io.BytesIO()
+    torch.save(record, buffer)
+    payload = buffer.getvalue()
+    sock.sendall(struct.pack('>Q', len(payload)) + payload)
+
+
+def end_stream(sock):
+    sock.sendall(struct.pack('>Q', 0))
+
+
+def watch_folder(folder, poll=1., idle_timeout=None, delete=True):
+    """ yields the records written to `folder`, in name order. Stops once no
+        new record appeared for `idle_timeout` seconds.
+
+        Producers must name the records in increasing order (e.g. zero padded
+        counters) : only the name of the last record read is kept, and records
+        named before it are ignored. Consumed records are deleted unless
+        `delete` is False, so that a poll only lists the pending ones """
+
+    last, last_new = '', time.time()
+
+    while True:
+        with os.scandir(folder) as entries:
+            new = sorted(e.name for e in entries if e.name.endswith('.pt') and e.name > last)
+
+        for name in new:
+            path = os.path.join(folder, name)
+            last = name
+            yield torch.load(path)
+
+            if delete: os.remove(path)
+
+        if len(new) > 0:
+            last_new = time.time()
+        elif idle_timeout is not None and time.time() - last_new > idle_timeout:
+            return
+        else:
+            time.sleep(poll)
+
+
+def listen_socket(port, host='localhost'):
+    """ yields the records sent by `send_record` to a local socket, one
+        connection after the other. Stops when a producer calls `end_stream` """
+
+    def read(conn, n):
+        out = b''
+        while len(out) < n:
+            chunk = conn.recv(n - len(out))
+            if not chunk: return None
+            out += chunk
+        return out
+
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind((host, port))
+    server.listen(1)
+
+    try:
+        while True:
+            conn, _ = server.accept()
+            with conn:
+                while True:
+                    header = read(conn, 8)
+                    if header is None: break
+
+                    size = struct.unpack('>Q', header)[0]
+                    if size == 0: return
+
+                    yield torch.load(io.BytesIO(read(conn, size)))
+    finally:
+        server.close()
+
+
+def get_source(args):
+    if args.stream_dir is not None:
+        return watch_folder(args.stream_dir, idle_timeout=args.stream_timeout,
+                            delete=not args.stream_keep)
+    elif args.stream_port is not None:
+        return listen_socket(args.stream_port)
+
+    raise ValueError('specify either `--stream_dir` or `--stream_port`')
+
+
+# Dataset
+# ---------------------------------------------------------------------------------
+
+class StreamDataset(torch.utils.data.IterableDataset):
+    """ reads a (possibly unbounded) source on a background thread.
+
+        At most `max_queue` batches are held in memory: when the consumer
+        (training loop) is slower than the source, the reader blocks, which in
+        turn stops reading from the folder / socket (backpressure).
+        Batches never straddle task boundaries. """
+
+    _END = object()
+
+    def __init__(self, source, batch_size, max_queue=16):
+        self.source = source
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.rescale = lambda x : (x.float() / 255. - 0.5) * 2.
+
+    def batches(self):
+        """ split incoming records into batches of (at most) `batch_size` """
+
+        step = 0
+        for record in self.source:
+            x, y, t = record['x'], record['y'].long(), int(record['t'])
+
+            if x.dtype == torch.uint8:
+                x = self.rescale(x)
+
+            for start in range(0, x.size(0), self.batch_size):
+                x_b, y_b = x[start:start + self.batch_size], y[start:start + self.batch_size]
+                steps = torch.arange(step, step + x_b.size(0))
+                step += x_b.size(0)
+
+                yield x_b, y_b, t, steps
+
+    def read(self):
+        try:
+            for batch in self.batches():
+                self.queue.put(batch)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.queue.put(self._END)
+
+    def __iter__(self):
+        self.error = None
+        reader = threading.Thread(target=self.read, daemon=True)
+        reader.start()
+
+        while True:
+            batch = self.queue.get()
+            if batch is self._END: break
+
+            yield batch
+
+        # surface errors of the reader thread in the training loop
+        if self.error is not None:
+            raise self.error
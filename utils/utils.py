@@ -11,37 +11,31 @@ import torch.nn.utils.weight_norm as wn
 from collections import OrderedDict as OD
 from collections import defaultdict as DD
 from copy import deepcopy
-from PIL import Image
-
-import matplotlib
-matplotlib.use('pdf')
-import matplotlib.mlab as mlab
-import matplotlib.pyplot as plt
+from functools import lru_cache
 
 # data
 # ---------------------------------------------------------------------------------
 def to_polar(velo):
-    if len(velo.shape) == 4:
-        velo = velo.permute(1, 2, 3, 0)
+    """ (x, y, z, ...) --> (dist, z). The channel axis is the second one for
+        (B, C, H, W) inputs, and the last one otherwise """
 
-    if velo.shape[2] > 4:
-        assert velo.shape[0] <= 4
-        velo = velo.permute(1, 2, 0, 3)
-        switch=True
-    else:
-        switch=False
+    c_dim = 1 if (velo.ndim == 4 and velo.shape[-1] > 4) else -1
+    x, y, z = [velo.select(c_dim, i) for i in range(3)]
+
+    return torch.stack([torch.hypot(x, y), z], dim=c_dim)
 
-    # assumes r x n/r x (3,4) velo
-    dist = torch.sqrt(velo[:, :, 0] ** 2 + velo[:, :, 1] ** 2)
-    out = torch.stack([dist, velo[:, :, 2]], dim=2)
 
-    if switch:
-        out = out.permute(2, 0, 1, 3)
+# cos / sin of the azimuth angles, per (width, device, dtype)
+TRIG_TABLES = {}
 
-    if len(velo.shape) == 4:
-        out = out.permute(3, 0, 1, 2)
+def trig_table(width, device, dtype):
+    key = (width, str(device), dtype)
+    if key not in TRIG_TABLES:
+        angles = np.linspace(0, np.pi * 2, width)
+        table  = torch.from_numpy(np.stack([np.cos(angles), np.sin(angles)]))
+        TRIG_TABLES[key] = table.to(device=device, dtype=dtype).view(1, 2, 1, width)
 
-    return out
+    return TRIG_TABLES[key]
 
 
 def from_polar(velo):
@@ -53,23 +47,33 @@ def from_polar(velo):
         # already in xyz
         return velo
 
-    angles = np.linspace(0, np.pi * 2, velo.shape[-1])
-    dist, z = velo[:, 0], velo[:, 1]
+    # (B, 1, H, W) * (1, 2, 1, W) --> x, y
+    xy = velo[:, :1] * trig_table(velo.size(-1), velo.device, velo.dtype)
+
+    return torch.cat((xy, velo[:, 1:]), dim=1)
+
 
-    x = torch.Tensor(np.cos(angles)).cuda().unsqueeze(0).unsqueeze(0) * dist
-    y = torch.Tensor(np.sin(angles)).cuda().unsqueeze(0).unsqueeze(0) * dist
-    out = torch.stack([x,y,z], dim=1)
+def to_cloud(velo):
+    """ (B, C, H, W) polar or xyz grid --> (B, H * W, 3) point cloud """
+    velo = from_polar(velo)
+    return velo.reshape(velo.size(0), 3, -1).transpose(-2, -1)
 
-    return out
 
+@lru_cache(maxsize=None)
+def get_chamfer(one_to_many=False):
+    """ returns chamfer(x, y), where x and y are (B, C, H, W) grids. With
+        `one_to_many`, y is a (M, B, C, H, W) stack of grids all compared to x.
+        Nothing is compiled here : the CUDA kernels are loaded on first use """
 
-def get_chamfer():
-    from chamfer_distance.chamfer_distance import ChamferDistance
+    from lidar.chamfer_distance import ChamferDistance
 
     chamfer_raw = ChamferDistance()
-    prepro      = lambda x : x.reshape(x.size(0), 3, -1).transpose(-2, -1)
 
-    chamfer = lambda x, y : chamfer_raw(prepro(from_polar(x)), prepro(from_polar(y)))[:2]
+    if one_to_many:
+        to_clouds = lambda ys : to_cloud(ys.flatten(0, 1)).view(ys.size(0), ys.size(1), -1, 3)
+        chamfer = lambda x, ys : chamfer_raw.one_to_many(to_cloud(x), to_clouds(ys))
+    else:
+        chamfer = lambda x, y : chamfer_raw(to_cloud(x), to_cloud(y))[:2]
 
     return chamfer
 
@@ -79,37 +83,61 @@ def get_chamfer():
 # ---------------------------------------------------------------------------------
 
 class RALog():
-    """ keeps track of running averages of values """
+    """ keeps track of running averages of values.
+
+        Tensors are summed (detached) on their device, and only transferred
+        in `avg_dict`, so logging never waits for the device. A value can be
+        a callable : it is only evaluated on the calls sampled by `intervals`
+        (key --> log once every `interval` calls), for expensive metrics """
 
-    def __init__(self):
+    def __init__(self, intervals=None):
+        self.intervals = intervals or {}
+        self.calls     = DD(int)
         self.reset()
 
     def reset(self):
-        self.storage  = OD()
+        self.storage  = OD()   # running sums
         self.count    = OD()
 
     def avg_dict(self, prefix=''):
         out = {}
-        for key in self.storage.keys():
-            avg = self.storage[key]
-            out[prefix + key] = avg
 
-        return out
+        # one transfer per device for the scalar tensors
+        scalars = DD(list)
+        for key, value in self.storage.items():
+            if torch.is_tensor(value) and value.numel() == 1:
+                scalars[value.device] += [key]
+            elif torch.is_tensor(value):
+                out[prefix + key] = value.cpu().numpy() / self.count[key]
+            else:
+                out[prefix + key] = value / self.count[key]
+
+        for keys in scalars.values():
+            values = torch.stack([self.storage[key].reshape(()) for key in keys]).tolist()
+            for key, value in zip(keys, values):
+                out[prefix + key] = value / self.count[key]
+
+        # keep the insertion order
+        return {prefix + key: out[prefix + key] for key in self.storage.keys()}
 
     def log(self, key, value):
-        if 'tensor' in str(type(value)).lower():
-            if value.numel() == 1:
-                value = value.item()
-            else:
-                value = value.cpu().data.numpy()
+        interval = self.intervals.get(key, 1)
+        self.calls[key] += 1
+
+        if (self.calls[key] - 1) % interval != 0:
+            return
+
+        if callable(value):
+            value = value()
+
+        if torch.is_tensor(value):
+            value = value.detach().float()
 
         if key not in self.storage.keys():
             self.count[key] = 1
             self.storage[key] = value
         else:
-            prev = self.storage[key]
-            cnt  = self.count[key]
-            self.storage[key] = (prev * cnt  + value) / (cnt + 1.)
+            self.storage[key] = self.storage[key] + value
             self.count[key] += 1
 
 
@@ -164,9 +192,8 @@ class dotdict(dict):
 # Model
 # ---------------------------------------------------------------------------------
 
-def load_model(model, path):
-    # load weights
-    params = torch.load(path)
+def load_state(model, params):
+    """ loads a QStack state dict, resizing the buffers and codebooks to match it """
 
     named_params = {x:y for (x,y) in model.named_parameters()}
     named_params.update({x:y for (x,y) in model.named_buffers()})
@@ -187,11 +214,17 @@ def load_model(model, path):
                 block_id = int(name.split('.')[1])
                 model.blocks[block_id].quantize.trim(n_embeds=n_embeds)
 
-    if sum('ema_decoder' in x for x in named_params) > 0:
-        for block in model.blocks:
-            block.ema_decoder = deepcopy(block.decoder)
+    # create the old decoders stored in `params`
+    for i, block in enumerate(model.blocks):
+        if any(name.startswith('blocks.%d.ema_decoder.' % i) for name in params):
+            block.init_ema()
 
     model.load_state_dict(params)
+
+
+def load_model(model, path):
+    # load weights
+    load_state(model, torch.load(path))
     print('successfully loaded model')
 
 